@@ -18,22 +18,14 @@ class LocusAdmin(admin.ModelAdmin):
         'assembly',
         'locus_id',
         'num_transcripts',
-        'best_transcript_length',
-        'best_transcript_coverage'
+        'max_length',
+        'best_length',
+        'best_coverage',
+        'num_hits',
         )
     list_filter = ('assembly__identifier',)
-    
-    def num_transcripts(self, obj):
-        return len(obj.transcript_set.all())
-    num_transcripts.short_description = 'Number of transcripts'
-    
-    def best_transcript_length(self, obj):
-        return Transcript.objects.best_for_locus(obj).length
-    best_transcript_length.short_description = 'Best transcript length'
-    
-    def best_transcript_coverage(self, obj):
-        return Transcript.objects.best_for_locus(obj).coverage
-    best_transcript_coverage.short_description = 'Best transcript coverage'
+    list_select_related = True
+    readonly_fields = ('num_transcripts', 'max_length', 'best_length', 'best_coverage', 'num_hits',)
     
 admin.site.register(Locus, LocusAdmin)
 
@@ -43,12 +35,22 @@ class TranscriptAdmin(admin.ModelAdmin):
     list_display = (
         'locus',
         'transcript_id',
-        'sequence',
+        'sequence_preview',
         'length',
         'confidence',
         'coverage',
         )
-    list_filter = ('locus__assembly__identifier', BlastHitsFilter)
+    list_filter = ('assembly__identifier', BlastHitsFilter)
+
+    def get_queryset(self, request):
+        qs = super(TranscriptAdmin, self).get_queryset(request)
+        return Transcript.objects.with_preview(qs)
+
+    def sequence_preview(self, obj):
+        if obj.preview_truncated:
+            return obj.sequence_preview + '...'
+        return obj.sequence_preview
+    sequence_preview.short_description = 'Sequence'
 
     #~ def wrapped_sequence(self, obj):
         #~ seq = ''
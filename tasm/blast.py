@@ -0,0 +1,273 @@
+from collections import namedtuple
+
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+ParseError = ElementTree.ParseError
+
+# The part of a BLAST hit stored in RefSeq and BlastHit. The alignment
+# statistics are those of the first (best) HSP.
+Hit = namedtuple('Hit', 'accession definition length align_length identities expect score')
+
+
+def _text(elem, tag, default=''):
+    value = elem.findtext(tag)
+    if value is None:
+        return default
+    return value
+
+
+def _parse_hit(elem):
+    hsp = elem.find('Hit_hsps/Hsp')
+    if hsp is None:
+        return None
+    return Hit(
+        accession=_text(elem, 'Hit_accession'),
+        definition=_text(elem, 'Hit_def'),
+        length=int(_text(elem, 'Hit_len', 0)),
+        align_length=int(_text(hsp, 'Hsp_align-len', 0)),
+        identities=int(_text(hsp, 'Hsp_identity', 0)),
+        expect=float(_text(hsp, 'Hsp_evalue')),
+        score=float(_text(hsp, 'Hsp_score'))
+        )
+
+
+def parse_blast_xml(handle, expect=None, max_hits=None):
+    '''
+    Streaming reader for BLAST XML output (-outfmt 5). Yields a
+    (query, hits) tuple per BLAST record (<Iteration>) where query is
+    the query definition line and hits a list of Hit tuples.
+
+    Hits with an expect value of the first HSP above expect are
+    skipped and at most max_hits are returned per query. Every hit is
+    discarded as soon as it has been read, so memory use does not
+    depend on the size of the file or the number of hits per query.
+    '''
+    iterations = None
+    default_query = query = ''
+    hits = []
+    for event, elem in ElementTree.iterparse(handle, events=('start', 'end')):
+        if event == 'start':
+            if elem.tag == 'BlastOutput_iterations':
+                iterations = elem
+            continue
+        tag = elem.tag
+        if tag == 'Hit':
+            if max_hits is None or len(hits) < max_hits:
+                hit = _parse_hit(elem)
+                if hit is not None and (expect is None or hit.expect <= expect):
+                    hits.append(hit)
+            elem.clear()
+        elif tag == 'Iteration_query-def':
+            query = elem.text or ''
+        elif tag == 'BlastOutput_query-def':
+            # Pre 2.2.14 BLAST only has the query in the header
+            default_query = elem.text or ''
+        elif tag == 'Iteration':
+            yield query or default_query, hits
+            query = ''
+            hits = []
+            if iterations is not None:
+                iterations.clear()
+            else:
+                elem.clear()
+
+
+# Columns needed to import tabular output, as given to -outfmt 6 or 7
+TABULAR_FIELDS = ('qseqid', 'sacc', 'stitle', 'slen', 'length', 'nident', 'evalue', 'score')
+
+# Column descriptions used in the '# Fields:' line of -outfmt 7 output
+FIELD_NAMES = {
+    'query id': 'qseqid',
+    'query acc.': 'qacc',
+    'query acc.ver': 'qaccver',
+    'query length': 'qlen',
+    'subject id': 'sseqid',
+    'subject ids': 'sallseqid',
+    'subject acc.': 'sacc',
+    'subject acc.ver': 'saccver',
+    'subject title': 'stitle',
+    'subject titles': 'salltitles',
+    'subject length': 'slen',
+    '% identity': 'pident',
+    'alignment length': 'length',
+    'identical': 'nident',
+    'mismatches': 'mismatch',
+    'gap opens': 'gapopen',
+    'q. start': 'qstart',
+    'q. end': 'qend',
+    's. start': 'sstart',
+    's. end': 'send',
+    'evalue': 'evalue',
+    'bit score': 'bitscore',
+    'score': 'score',
+    }
+
+# Sequence id prefixes that are not followed by an NCBI accession
+LOCAL_ID_TAGS = ('lcl', 'gnl')
+
+
+def detect_format(head):
+    '''
+    Tells BLAST XML ('xml') from tabular output ('tabular') based on
+    the first bytes of the file.
+    '''
+    if head.lstrip().startswith(b'<'):
+        return 'xml'
+    return 'tabular'
+
+
+def strip_version(accession):
+    '''
+    NM_000077.1 -> NM_000077, the accession as reported by
+    Hit_accession in XML output.
+    '''
+    base, dot, version = accession.rpartition('.')
+    if dot and base and version.isdigit():
+        return base
+    return accession
+
+
+def seqid_accession(seqid):
+    '''
+    Derives the accession reported as Hit_accession in XML output from
+    a BLAST sequence id such as gi|1077|ref|NM_000077.1| or
+    NM_000077.1 (NM_000077).
+    '''
+    if '|' not in seqid:
+        return strip_version(seqid)
+    bits = seqid.split('|')
+    if bits[0] == 'gi' and len(bits) > 3:
+        bits = bits[2:]
+    if bits[0] in LOCAL_ID_TAGS:
+        return bits[-1] or bits[-2]
+    return strip_version(bits[1])
+
+
+def check_tabular_fields(fields):
+    '''
+    Raises ValueError unless fields has all the columns needed for the
+    same RefSeq and BlastHit rows as XML output: the subject accession
+    (sacc, saccver or sseqid), title and length and the raw score.
+    '''
+    for required in ('qseqid', 'stitle', 'slen', 'length', 'evalue', 'score'):
+        if required not in fields:
+            raise ValueError(
+                'Tabular BLAST output has no {0} column, use e.g. -outfmt "{1}".'.format(
+                    required, ' '.join(TABULAR_FIELDS)))
+    if not set(('sacc', 'saccver', 'sseqid')) & set(fields):
+        raise ValueError('Tabular BLAST output has no sacc, saccver or sseqid column.')
+    if 'nident' not in fields and 'pident' not in fields:
+        raise ValueError('Tabular BLAST output has no nident or pident column.')
+
+
+def _tabular_columns(fields):
+    '''
+    Returns the index of the query column and a function building a
+    Hit from the columns of a line in the given fields order. Raises
+    ValueError if any of the required fields is missing.
+    '''
+    check_tabular_fields(fields)
+    index = dict((name, i) for i, name in enumerate(fields))
+    get = lambda name: index.get(name)
+    acc, accver, seqid = get('sacc'), get('saccver'), get('sseqid')
+    title, slen, score = get('stitle'), get('slen'), get('score')
+    length, nident, pident, evalue = get('length'), get('nident'), get('pident'), get('evalue')
+    size = len(fields)
+
+    def accession(cols):
+        if acc is not None:
+            return cols[acc]
+        if accver is not None:
+            return strip_version(cols[accver])
+        return seqid_accession(cols[seqid])
+
+    def build(cols):
+        if len(cols) != size:
+            raise ValueError('Expected {0} columns, got {1}: {2}'.format(
+                size, len(cols), b'\t'.join(cols)))
+        align_length = int(cols[length])
+        if nident is not None:
+            identities = int(cols[nident])
+        else:
+            identities = int(round(float(cols[pident]) * align_length / 100))
+        return Hit(
+            accession=accession(cols),
+            definition=cols[title],
+            length=int(cols[slen]),
+            align_length=align_length,
+            identities=identities,
+            expect=float(cols[evalue]),
+            score=float(cols[score])
+            )
+    return index['qseqid'], build
+
+
+def _field_names(line):
+    names = [name.strip() for name in line[len(b'# Fields:'):].split(b',')]
+    return [FIELD_NAMES.get(name, name) for name in names]
+
+
+def tabular_fields(handle, fields=TABULAR_FIELDS):
+    '''
+    Returns the columns of tabular BLAST output from the first
+    '# Fields:' comment before any data line (-outfmt 7), or fields
+    if there is none (-outfmt 6).
+    '''
+    for line in iter(handle.readline, b''):
+        if line.startswith(b'# Fields:'):
+            return _field_names(line)
+        if line.strip() and not line.startswith(b'#'):
+            break
+    return list(fields)
+
+
+def parse_blast_tabular(handle, expect=None, max_hits=None, fields=TABULAR_FIELDS):
+    '''
+    Reader for tabular BLAST output (-outfmt 6 and 7), yielding the
+    same (query, hits) tuples as parse_blast_xml. The columns are
+    taken from the '# Fields:' comment of -outfmt 7 output, otherwise
+    fields lists them (as given to -outfmt). Queries reported with 0
+    hits in -outfmt 7 output are skipped.
+
+    Lines for a query are expected to be consecutive, as written by
+    BLAST. Only the first (best) line of every subject is used. The
+    columns must include the subject title, length and the raw score
+    (see check_tabular_fields), e.g.
+        -outfmt "6 qseqid sacc stitle slen length nident evalue score"
+    which the default -outfmt 6 columns don't.
+    '''
+    columns = None
+    query = None
+    hits = []
+    seen = set()
+    for line in iter(handle.readline, b''):
+        line = line.rstrip(b'\r\n')
+        if not line:
+            continue
+        if line.startswith(b'#'):
+            if line.startswith(b'# Fields:'):
+                columns = _tabular_columns(_field_names(line))
+            continue
+        if columns is None:
+            columns = _tabular_columns(fields)
+        query_col, build = columns
+        cols = line.split(b'\t')
+        if cols[query_col] != query:
+            if query is not None:
+                yield query, hits
+            query = cols[query_col]
+            hits = []
+            seen = set()
+        if max_hits is not None and len(hits) >= max_hits:
+            continue
+        hit = build(cols)
+        if hit.accession in seen:
+            continue
+        seen.add(hit.accession)
+        if expect is None or hit.expect <= expect:
+            hits.append(hit)
+    if query is not None:
+        yield query, hits
@@ -0,0 +1,257 @@
+import os
+import re
+import tempfile
+from contextlib import contextmanager
+
+from django.core.management.color import no_style
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.models import AutoField
+from django.utils.encoding import force_bytes
+
+CREATE_INDEX_RE = re.compile(r'CREATE INDEX (\S+) ON ')
+
+
+def _load_fields(model):
+    return [f for f in model._meta.concrete_fields if not isinstance(f, AutoField)]
+
+
+def _tsv_value(value):
+    '''
+    Formats a single value in the text format understood by both
+    MySQL's LOAD DATA and PostgreSQL's COPY.
+    '''
+    if value is None:
+        return b'\\N'
+    if isinstance(value, bool):
+        return b'1' if value else b'0'
+    if isinstance(value, float):
+        return force_bytes(repr(value))
+    value = force_bytes(value)
+    return (value.replace(b'\\', b'\\\\')
+        .replace(b'\t', b'\\t')
+        .replace(b'\n', b'\\n')
+        .replace(b'\r', b'\\r'))
+
+
+def _write_tsv(handle, rows):
+    n = 0
+    for row in rows:
+        handle.write(b'\t'.join(_tsv_value(v) for v in row))
+        handle.write(b'\n')
+        n += 1
+    return n
+
+
+def bulk_load(model, rows, using=DEFAULT_DB_ALIAS):
+    '''
+    Inserts rows into the model table with the native bulk loader of
+    the database backend, bypassing model instances altogether. rows
+    is an iterable of dicts keyed by field attname (e.g. assembly_id);
+    missing fields get their default value. Returns the number of rows
+    loaded.
+
+    MySQL rows are staged in a TSV file and loaded with LOAD DATA
+    LOCAL INFILE, which needs local_infile enabled on both the server
+    and the client ('OPTIONS': {'local_infile': 1} in DATABASES).
+    PostgreSQL uses COPY from the staged file. Other backends fall
+    back to a single executemany INSERT.
+    '''
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    fields = _load_fields(model)
+    table = qn(model._meta.db_table)
+    columns = ', '.join(qn(f.column) for f in fields)
+    values = (
+        [f.get_db_prep_save(row.get(f.attname, f.get_default()), connection) for f in fields]
+        for row in rows
+        )
+    cursor = connection.cursor()
+    if connection.vendor not in ('mysql', 'postgresql'):
+        values = list(values)
+        if values:
+            sql = 'INSERT INTO {table} ({columns}) VALUES ({params})'.format(
+                table=table,
+                columns=columns,
+                params=', '.join(['%s'] * len(fields))
+                )
+            cursor.executemany(sql, values)
+        return len(values)
+    fd, path = tempfile.mkstemp(prefix='tasm-', suffix='.tsv')
+    try:
+        with os.fdopen(fd, 'wb') as fo:
+            n = _write_tsv(fo, values)
+        if not n:
+            return 0
+        if connection.vendor == 'mysql':
+            cursor.execute(
+                'LOAD DATA LOCAL INFILE %s INTO TABLE {table} CHARACTER SET utf8 ({columns})'.format(
+                    table=table, columns=columns),
+                [path])
+        else:
+            with open(path, 'rb') as fi:
+                cursor.copy_expert('COPY {table} ({columns}) FROM STDIN'.format(
+                    table=table, columns=columns), fi)
+        return n
+    finally:
+        os.remove(path)
+
+
+def _upsert_suffix(connection, conflict, update):
+    '''
+    Returns the clause turning a multi-row INSERT into an upsert on
+    the backend, or None if it has none.
+    '''
+    qn = connection.ops.quote_name
+    if connection.vendor == 'mysql':
+        return ' ON DUPLICATE KEY UPDATE ' + ', '.join(
+            '{0} = VALUES({0})'.format(qn(c)) for c in update)
+    if ((connection.vendor == 'postgresql' and connection.pg_version >= 90500) or
+            (connection.vendor == 'sqlite' and connection.Database.sqlite_version_info >= (3, 24, 0))):
+        return ' ON CONFLICT ({0}) DO UPDATE SET {1}'.format(
+            ', '.join(qn(c) for c in conflict),
+            ', '.join('{0} = excluded.{0}'.format(qn(c)) for c in update))
+    return None
+
+
+def bulk_upsert(model, rows, unique, using=DEFAULT_DB_ALIAS, chunk_size=100):
+    '''
+    Inserts rows (dicts keyed by field attname, as for bulk_load) into
+    the model table, updating the other fields of the rows that already
+    exist instead. unique names the fields of the unique constraint
+    that identifies a row, e.g. ('transcript', 'refseq'). Returns the
+    number of rows written.
+
+    Uses INSERT ... ON DUPLICATE KEY UPDATE on MySQL and INSERT ... ON
+    CONFLICT DO UPDATE on PostgreSQL 9.5+ and SQLite 3.24+. Elsewhere
+    the matching rows are deleted and inserted again.
+    '''
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    fields = _load_fields(model)
+    conflict = [model._meta.get_field(name).column for name in unique]
+    update = [f.column for f in fields if f.column not in conflict]
+    rows = list(rows)
+    if not rows:
+        return 0
+    suffix = _upsert_suffix(connection, conflict, update)
+    if suffix is None:
+        keys = [model._meta.get_field(name).attname for name in unique]
+        for row in rows:
+            model._default_manager.using(using).filter(
+                **dict((k, row[k]) for k in keys)).delete()
+        model._default_manager.using(using).bulk_create([model(**row) for row in rows])
+        return len(rows)
+    sql = 'INSERT INTO {table} ({columns}) VALUES '.format(
+        table=qn(model._meta.db_table),
+        columns=', '.join(qn(f.column) for f in fields))
+    placeholder = '({0})'.format(', '.join(['%s'] * len(fields)))
+    cursor = connection.cursor()
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        params = []
+        for row in chunk:
+            params.extend(f.get_db_prep_save(row.get(f.attname, f.get_default()), connection)
+                for f in fields)
+        cursor.execute(sql + ', '.join([placeholder] * len(chunk)) + suffix, params)
+    return len(rows)
+
+
+def model_indexes(model, using=DEFAULT_DB_ALIAS):
+    '''
+    Returns (name, sql) for every secondary index of the model as
+    created by syncdb: indexed fields, foreign keys and index_together.
+    '''
+    connection = connections[using]
+    indexes = []
+    for sql in connection.creation.sql_indexes_for_model(model, no_style()):
+        name = CREATE_INDEX_RE.match(sql).group(1)
+        indexes.append((name.strip('"`'), sql.rstrip(';')))
+    return indexes
+
+
+def _table_indexes(connection, table):
+    '''
+    Returns the names of all indexes on table, or None if they can't
+    be listed on the backend.
+    '''
+    cursor = connection.cursor()
+    if connection.vendor == 'postgresql':
+        cursor.execute('SELECT indexname FROM pg_indexes WHERE tablename = %s', [table])
+    elif connection.vendor == 'sqlite':
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = %s", [table])
+    elif connection.vendor == 'mysql':
+        cursor.execute(
+            'SELECT DISTINCT index_name FROM information_schema.statistics '
+            'WHERE table_schema = DATABASE() AND table_name = %s', [table])
+    else:
+        return None
+    return set(name for name, in cursor.fetchall())
+
+
+def restore_indexes(model, using=DEFAULT_DB_ALIAS):
+    '''
+    Creates the secondary indexes of the model that are missing from
+    its table, e.g. after an import with indexes_disabled was killed.
+    Returns the names of the indexes created.
+    '''
+    connection = connections[using]
+    existing = _table_indexes(connection, model._meta.db_table)
+    if existing is None:
+        return []
+    cursor = connection.cursor()
+    created = []
+    for name, sql in model_indexes(model, using):
+        if name not in existing:
+            cursor.execute(sql)
+            created.append(name)
+    return created
+
+
+def _fk_indexes(connection, table):
+    '''
+    Returns the names of the indexes on a MySQL table whose first
+    column has a foreign key constraint. InnoDB needs them for the
+    constraint and refuses to drop them.
+    '''
+    cursor = connection.cursor()
+    cursor.execute(
+        'SELECT DISTINCT s.index_name FROM information_schema.statistics s '
+        'JOIN information_schema.key_column_usage k ON k.table_schema = s.table_schema '
+        'AND k.table_name = s.table_name AND k.column_name = s.column_name '
+        'WHERE s.table_schema = DATABASE() AND s.table_name = %s AND s.seq_in_index = 1 '
+        'AND k.referenced_table_name IS NOT NULL', [table])
+    return set(name for name, in cursor.fetchall())
+
+
+@contextmanager
+def indexes_disabled(model, using=DEFAULT_DB_ALIAS):
+    '''
+    Drops the secondary indexes of the model table for the duration of
+    a bulk load and rebuilds them afterwards. The indexes are rebuilt
+    from the model (see model_indexes), not from what was dropped, so
+    restore_indexes brings them back if the load never finishes.
+
+    On MySQL the indexes backing a foreign key constraint (InnoDB) are
+    kept. Index changes commit implicitly on MySQL, so this must be
+    used outside of any transaction.
+    '''
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    table = model._meta.db_table
+    existing = _table_indexes(connection, table)
+    if existing is None:
+        yield
+        return
+    drop = 'DROP INDEX {0}'
+    if connection.vendor == 'mysql':
+        existing -= _fk_indexes(connection, table)
+        drop = 'DROP INDEX {0} ON ' + qn(table)
+    cursor = connection.cursor()
+    for name, sql in model_indexes(model, using):
+        if name in existing:
+            cursor.execute(drop.format(qn(name)))
+    try:
+        yield
+    finally:
+        restore_indexes(model, using)
@@ -0,0 +1,78 @@
+'''
+Caching of list view results. Cache keys include a generation number
+per assembly (and a global one) which is bumped whenever an import
+changes the assembly, so stale results are never read and simply age
+out of the cache (TIMEOUT and MAX_ENTRIES of the backend).
+
+The cache is settings.TASM_CACHE ('default' if not set). Imports run
+in manage.py, so it has to be a cache shared between processes (file
+or memcached) for invalidation to reach the web server.
+'''
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import get_cache
+
+CACHE_ALIAS = getattr(settings, 'TASM_CACHE', 'default')
+
+GLOBAL_GENERATION_KEY = 'tasm:generation'
+ASSEMBLY_GENERATION_KEY = 'tasm:generation:asm:{0}'
+
+
+def get_list_cache():
+    return get_cache(CACHE_ALIAS)
+
+
+def _new_generation():
+    # Not 1: a generation that was culled must not come back with the
+    # value of its first use
+    return int(time.time() * 1000)
+
+
+def generations(asm_pk=None):
+    '''
+    Returns the (global, assembly) generation numbers, initializing
+    them if they're not in the cache.
+    '''
+    cache = get_list_cache()
+    keys = [GLOBAL_GENERATION_KEY]
+    if asm_pk is not None:
+        keys.append(ASSEMBLY_GENERATION_KEY.format(asm_pk))
+    values = cache.get_many(keys)
+    result = []
+    for key in keys:
+        if key not in values:
+            cache.add(key, _new_generation(), None)
+            values[key] = cache.get(key)
+        result.append(values[key])
+    return tuple(result)
+
+
+def _bump(cache, key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, _new_generation(), None)
+
+
+def invalidate(asm_pk=None):
+    '''
+    Invalidates the cached lists of the assembly with asm_pk and the
+    ones that are not per assembly (e.g. all refseqs).
+    '''
+    cache = get_list_cache()
+    _bump(cache, GLOBAL_GENERATION_KEY)
+    if asm_pk is not None:
+        _bump(cache, ASSEMBLY_GENERATION_KEY.format(asm_pk))
+
+
+def list_cache_key(path, asm_pk, params):
+    '''
+    Cache key of a list view at path (the view and its URL arguments)
+    for the given params (filters, ordering, page, ...) and the current
+    generations of the assembly.
+    '''
+    normalized = sorted((str(k), repr(v)) for k, v in params.items())
+    digest = hashlib.md5(repr((path, generations(asm_pk), normalized))).hexdigest()
+    return 'tasm:list:{0}'.format(digest)
@@ -12,6 +12,8 @@ class BlastHitsFilter(SimpleListFilter):
         
     def queryset(self, request, queryset):
         if self.value() == 'none':
-            return queryset.filter(blast_hits__isnull=True)
+            return queryset.filter(num_hits=0)
+        elif self.value() == 'some':
+            return queryset.filter(num_hits__gt=0)
         else:
             return queryset
@@ -0,0 +1,184 @@
+'''
+Keyset (seek) pagination. Instead of LIMIT/OFFSET, every page is
+fetched with a WHERE clause on the ordering key of the last (or
+first) row of the previous page, so deep pages cost the same as the
+first one and no COUNT is needed. The position is passed around as an
+opaque cursor.
+'''
+import base64
+import json
+
+from django.db import connections
+from django.db.models import Q
+from django.db.models.fields import FieldDoesNotExist
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(',', ':')))
+
+
+def decode_cursor(cursor, size):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise InvalidCursor('Invalid cursor: {0}'.format(cursor))
+    if not isinstance(values, list) or len(values) != size:
+        raise InvalidCursor('Invalid cursor: {0}'.format(cursor))
+    return values
+
+
+def orderable(model, name):
+    '''
+    True if name (as in an order_by() list, e.g. -locus__locus_id) is
+    a concrete field of model that is never NULL, reached through
+    foreign keys that are never NULL either, so it can be a key of
+    keyset_ordering. Rows with NULL keys would never be sought to.
+    '''
+    opts = model._meta
+    parts = name.lstrip('-').split('__')
+    for i, part in enumerate(parts):
+        if part == 'pk':
+            field = opts.pk
+        else:
+            try:
+                field = opts.get_field(part, many_to_many=False)
+            except FieldDoesNotExist:
+                return False
+        if field.null:
+            return False
+        if i < len(parts) - 1:
+            if not field.rel:
+                return False
+            opts = field.rel.to._meta
+    return True
+
+
+def keyset_ordering(model, ordering):
+    '''
+    Turns an order_by() list into (lookup, attribute, descending) tuples
+    usable as a keyset: foreign keys are ordered by the related pk
+    (locus__id, not the ordering of Locus) and the pk is added as the
+    last key so that the ordering is total. The ordering fields must
+    not be NULL.
+    '''
+    opts = model._meta
+    keys = []
+    for name in ordering:
+        descending = name.startswith('-')
+        name = name.lstrip('-')
+        if name == '?':
+            continue
+        attr = name
+        if name == 'pk':
+            name = attr = opts.pk.name
+        elif '__' not in name:
+            field = opts.get_field(name)
+            attr = field.attname
+            if field.rel:
+                name = '{0}__{1}'.format(name, field.rel.get_related_field().name)
+        if name not in [key[0] for key in keys]:
+            keys.append((name, attr, descending))
+    if opts.pk.name not in [key[0] for key in keys]:
+        keys.append((opts.pk.name, opts.pk.attname, False))
+    return keys
+
+
+def _key_value(obj, attr):
+    for name in attr.split('__'):
+        obj = getattr(obj, name)
+    return obj
+
+
+class KeysetPage(object):
+
+    def __init__(self, object_list, keys, has_next, has_previous):
+        self.object_list = object_list
+        self.has_next = has_next
+        self.has_previous = has_previous
+        self._keys = keys
+
+    def _cursor(self, obj):
+        return encode_cursor([_key_value(obj, attr) for name, attr, desc in self._keys])
+
+    @property
+    def next_cursor(self):
+        if self.object_list:
+            return self._cursor(self.object_list[-1])
+
+    @property
+    def previous_cursor(self):
+        if self.object_list:
+            return self._cursor(self.object_list[0])
+
+
+class KeysetPaginator(object):
+    '''
+    Paginates queryset by the keyset derived from ordering (see
+    keyset_ordering). page(after=cursor) returns the rows following
+    the cursor, page(before=cursor) the rows preceding it.
+    '''
+    def __init__(self, queryset, ordering, per_page):
+        self.queryset = queryset
+        self.keys = keyset_ordering(queryset.model, ordering)
+        self.per_page = per_page
+
+    def _order_by(self, reverse=False):
+        return ['-' + name if desc != reverse else name for name, attr, desc in self.keys]
+
+    def _seek(self, values, forward=True):
+        '''
+        (k1, k2, ...) > (v1, v2, ...) for the mixed ascending and
+        descending keys, spelled out as an OR of AND terms.
+        '''
+        q = Q()
+        for i, (name, attr, descending) in enumerate(self.keys):
+            term = dict((self.keys[j][0], values[j]) for j in range(i))
+            term['{0}__{1}'.format(name, 'lt' if descending == forward else 'gt')] = values[i]
+            q |= Q(**term)
+        return q
+
+    def page(self, after=None, before=None):
+        size = len(self.keys)
+        if before:
+            values = decode_cursor(before, size)
+            qs = self.queryset.filter(self._seek(values, forward=False))
+            rows = list(qs.order_by(*self._order_by(reverse=True))[:self.per_page + 1])
+            has_previous = len(rows) > self.per_page
+            rows = rows[:self.per_page][::-1]
+            return KeysetPage(rows, self.keys, has_next=True, has_previous=has_previous)
+        qs = self.queryset
+        if after:
+            qs = qs.filter(self._seek(decode_cursor(after, size)))
+        rows = list(qs.order_by(*self._order_by())[:self.per_page + 1])
+        has_next = len(rows) > self.per_page
+        return KeysetPage(rows[:self.per_page], self.keys,
+            has_next=has_next, has_previous=bool(after))
+
+
+def estimated_count(queryset):
+    '''
+    Number of rows of queryset as estimated by the query planner, or
+    None if the backend has no cheap estimate (SQLite). Much cheaper
+    than COUNT(DISTINCT ...) on large tables but can be way off.
+    '''
+    connection = connections[queryset.db]
+    if connection.vendor not in ('postgresql', 'mysql'):
+        return None
+    sql, params = queryset.order_by().query.sql_with_params()
+    cursor = connection.cursor()
+    if connection.vendor == 'postgresql':
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+        if not isinstance(plan, list):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+    cursor.execute('EXPLAIN ' + sql, params)
+    columns = [col[0] for col in cursor.description]
+    row = cursor.fetchone()
+    if row is None or row[columns.index('rows')] is None:
+        return None
+    return int(row[columns.index('rows')])
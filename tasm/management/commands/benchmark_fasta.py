@@ -0,0 +1,68 @@
+from __future__ import division
+import os, time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from tasm.readers import read_fasta
+from tasm.utils import parse_header
+
+
+class Command(BaseCommand):
+    '''
+    Compares the throughput of the FASTA reader used by setup_database
+    with biopython's SeqIO on the given file (typically a large
+    transcripts.fa). Every reader parses the headers and builds the
+    full sequence, which is the work the import commands need done.
+    '''
+    option_list = BaseCommand.option_list + (
+        make_option('--skip-seqio', action='store_true', default=False,
+            dest='skip_seqio', help='Do not run the SeqIO baseline'),
+        )
+    args = '<file.fa>'
+
+    def _run_seqio(self, filename):
+        from Bio import SeqIO
+        n = 0
+        with open(filename, 'rU') as fi:
+            for rec in SeqIO.parse(fi, 'fasta'):
+                rec.id.split('_')
+                str(rec.seq)
+                n += 1
+        return n
+
+    def _run_reader(self, filename, use_mmap):
+        n = 0
+        for header, seq in read_fasta(filename, use_mmap=use_mmap):
+            parse_header(header)
+            n += 1
+        return n
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Invalid number of arguments.')
+        filename = args[0]
+        if not os.path.exists(filename):
+            raise CommandError('File {file} not found.'.format(file=filename))
+        size = os.path.getsize(filename) / 1024 / 1024
+        runs = []
+        if not options['skip_seqio']:
+            runs.append(('Bio.SeqIO', lambda: self._run_seqio(filename)))
+        runs.append(('read_fasta', lambda: self._run_reader(filename, False)))
+        runs.append(('read_fasta (mmap)', lambda: self._run_reader(filename, True)))
+        self.stdout.write('Reading {file} ({size:.1f} MB) ...'.format(file=filename, size=size))
+        baseline = None
+        for name, run in runs:
+            start = time.time()
+            n = run()
+            elapsed = time.time() - start
+            if baseline is None:
+                baseline = elapsed
+            self.stdout.write('{name:<20} {n} records in {elapsed:.2f} sec, {mbs:.1f} MB/sec, {rps:.0f} records/sec, x{speedup:.1f}'.format(
+                name=name,
+                n=n,
+                elapsed=elapsed,
+                mbs=size / elapsed if elapsed else 0,
+                rps=n / elapsed if elapsed else 0,
+                speedup=baseline / elapsed if elapsed else 0
+                ))
@@ -0,0 +1,81 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from tasm.keyset import keyset_ordering
+from tasm.models import Assembly, Transcript
+from tasm.views import FilteredListView
+
+EXPLAIN = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+    'postgresql': 'EXPLAIN ANALYZE ',
+    'mysql': 'EXPLAIN ',
+    }
+
+
+class Command(BaseCommand):
+    '''
+    Shows the query plan and timing of the transcript list query of an
+    assembly with coverage and length filters, once filtering on the
+    assembly of the locus (joining Locus) and once on the assembly
+    stored with the transcript. The page query is the one of the
+    transcript list view: default ordering, keyset paginated.
+    '''
+    option_list = BaseCommand.option_list + (
+        make_option('--coverage-gte', default=10.0, type='float', dest='coverage',
+            help='Minimum coverage'),
+        make_option('--length-gte', default=500, type='int', dest='length',
+            help='Minimum length'),
+        make_option('--repeat', default=5, type='int', dest='repeat',
+            help='Number of runs of every query, the best one is reported'),
+        )
+    args = '<assembly identifier>'
+
+    def explain(self, qs):
+        connection = connections[qs.db]
+        sql, params = qs.query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute(EXPLAIN.get(connection.vendor, 'EXPLAIN ') + sql, params)
+        for row in cursor.fetchall():
+            self.stdout.write('\t' + ' | '.join(str(col) for col in row))
+
+    def timeit(self, func):
+        best = None
+        for i in range(self.repeat):
+            start = time.time()
+            func()
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        return best
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Invalid number of arguments.')
+        try:
+            asm = Assembly.objects.get(identifier=args[0])
+        except Assembly.DoesNotExist:
+            raise CommandError('Unknown assembly: {asm}.'.format(asm=args[0]))
+        self.repeat = max(options['repeat'], 1)
+        filters = dict(coverage__gte=options['coverage'], length__gte=options['length'])
+        # As ordered by KeysetPaginator in FilteredListView
+        ordering = ['-' + key if desc else key
+            for key, attr, desc in keyset_ordering(Transcript, Transcript._meta.ordering)]
+        variants = (
+            ('locus__assembly__pk', Transcript.objects.filter(locus__assembly__pk=asm.pk)),
+            ('assembly__pk', Transcript.objects.filter(assembly__pk=asm.pk)),
+            )
+        for name, qs in variants:
+            qs = Transcript.objects.with_preview(qs).filter(**filters)
+            # First page of the transcript list, one more row to know
+            # if there is a next page
+            page = qs.order_by(*ordering)[:FilteredListView.keyset_per_page + 1]
+            self.stdout.write('Filtering on {name}:'.format(name=name))
+            self.stdout.write('  page query plan')
+            self.explain(page)
+            self.stdout.write('  page: {0:.2f} ms, count: {1:.2f} ms ({2} transcripts)'.format(
+                self.timeit(lambda: list(page.all())) * 1000,
+                self.timeit(qs.count) * 1000,
+                qs.count()))
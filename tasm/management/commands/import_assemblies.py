@@ -0,0 +1,206 @@
+from __future__ import division
+import os, sys, time
+from multiprocessing import Pool, Semaphore
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from tasm.bulkload import indexes_disabled, restore_indexes
+from tasm.management.commands import setup_database
+from tasm.models import Contig, Stat, Transcript
+
+MANIFEST_FIELDS = ('identifier', 'species', 'k_min', 'k_max', 'dir')
+
+# Tables written by setup_database
+MODELS = (Contig, Stat, Transcript)
+
+
+class PrefixedStream(object):
+    '''
+    File-like wrapper that prefixes every line written with the
+    assembly identifier so output of concurrent imports can be told
+    apart.
+    '''
+    def __init__(self, prefix, stream):
+        self.prefix = prefix
+        self.stream = stream
+
+    def write(self, msg):
+        lines = msg.splitlines(True)
+        self.stream.write(''.join('[{0}] {1}'.format(self.prefix, line) for line in lines))
+        self.stream.flush()
+
+    def flush(self):
+        self.stream.flush()
+
+
+_write_lock = None
+
+def _init_worker(write_lock):
+    global _write_lock
+    _write_lock = write_lock
+
+def _import_assembly(args):
+    '''
+    Runs setup_database for a single manifest entry in a worker
+    process. Returns (identifier, phase stats, seconds, error).
+    '''
+    entry, options = args
+    # Never reuse a connection inherited from the parent process
+    connection.close()
+    cmd = setup_database.Command()
+    cmd.write_lock = _write_lock
+    # Indexes are handled once by the parent process
+    cmd.manage_indexes = False
+    defaults = dict((opt.dest, opt.default) for opt in cmd.option_list if opt.dest)
+    defaults.update(options)
+    defaults.update(
+        species=entry['species'],
+        k_min=entry['k_min'],
+        k_max=entry['k_max'],
+        dir=entry['dir'],
+        stdout=PrefixedStream(entry['identifier'], sys.stdout)
+        )
+    start = time.time()
+    try:
+        cmd.execute(entry['identifier'], **defaults)
+    except Exception as e:
+        return entry['identifier'], getattr(cmd, 'phase_stats', []), time.time() - start, str(e)
+    finally:
+        connection.close()
+    return entry['identifier'], cmd.phase_stats, time.time() - start, None
+
+
+class Command(BaseCommand):
+    '''
+    Imports a batch of oases assemblies concurrently. The manifest is a
+    tab delimited file with a line per assembly:
+        identifier  species  k_min  k_max  dir
+    Empty lines and lines starting with # are ignored.
+
+    Every assembly is imported by setup_database in a separate process.
+    The number of processes writing to the database at the same time
+    is limited by --db-writers, parsing and coverage computation are
+    not throttled. A summary of rows and rows/sec per phase for every
+    assembly is printed at the end. With --fast-load the indexes of the
+    shared tables are dropped once before the imports start and
+    rebuilt once after all of them have finished.
+    '''
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', default='4', dest='processes',
+            help='Number of assemblies imported concurrently'),
+        make_option('--db-writers', default='2', dest='db_writers',
+            help='Maximum number of imports writing to the database at once'),
+        make_option('--batch-size', default='5000', dest='batch_size',
+            help='Number of rows written to the database per batch'),
+        make_option('--mmap', action='store_true', default=False, dest='mmap',
+            help='Memory map FASTA input files instead of buffered reads'),
+        make_option('--fast-load', action='store_true', default=False, dest='fast_load',
+            help='Use the native bulk loader of the database backend'),
+        make_option('--resume', action='store_true', default=False, dest='resume',
+            help='Resume interrupted imports of the assemblies'),
+        )
+    args = '<manifest.tsv>'
+
+    def set_options(self, **options):
+        '''
+        Set instance variables based on options dict
+        '''
+        try:
+            self.processes = int(options['processes'])
+            self.db_writers = int(options['db_writers'])
+        except ValueError:
+            raise CommandError('processes and db_writers must be integers.')
+        if self.processes < 1 or self.db_writers < 1:
+            raise CommandError('processes and db_writers must be positive.')
+        self.fast_load = options['fast_load']
+        self.import_options = dict(
+            batch_size=options['batch_size'],
+            mmap=options['mmap'],
+            fast_load=options['fast_load'],
+            resume=options['resume'],
+            verbosity=options['verbosity']
+            )
+
+    def read_manifest(self, filename):
+        entries = []
+        with open(filename, 'rU') as fi:
+            for i, line in enumerate(fi, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                bits = line.split('\t')
+                if len(bits) != len(MANIFEST_FIELDS):
+                    raise CommandError('Line {0} of {1}: expected {2} fields, got {3}.'.format(
+                        i, filename, len(MANIFEST_FIELDS), len(bits)))
+                entry = dict(zip(MANIFEST_FIELDS, bits))
+                if not os.path.exists(entry['dir']):
+                    raise CommandError('Directory %s does not exist.' % entry['dir'])
+                entries.append(entry)
+        identifiers = [e['identifier'] for e in entries]
+        if len(set(identifiers)) != len(identifiers):
+            raise CommandError('Assembly identifiers in the manifest must be unique.')
+        return entries
+
+    def write_summary(self, results):
+        self.stdout.write('')
+        self.stdout.write('{0:<20} {1:<12} {2:>12} {3:>10} {4:>12}'.format(
+            'Assembly', 'Phase', 'Rows', 'Seconds', 'Rows/sec'))
+        for identifier, stats, elapsed, error in results:
+            for phase, rows, seconds in stats:
+                self.stdout.write('{0:<20} {1:<12} {2:>12} {3:>10.1f} {4:>12.0f}'.format(
+                    identifier, phase, rows, seconds, rows / seconds if seconds else 0))
+            total = sum(rows for phase, rows, seconds in stats)
+            self.stdout.write('{0:<20} {1:<12} {2:>12} {3:>10.1f} {4:>12.0f}'.format(
+                identifier, 'FAILED' if error else 'total', total, elapsed,
+                total / elapsed if elapsed else 0))
+
+    def import_assemblies(self, entries):
+        '''
+        Imports the manifest entries in a pool of processes and returns
+        the results of _import_assembly.
+        '''
+        connection.close()
+        pool = Pool(self.processes, _init_worker, (Semaphore(self.db_writers),))
+        results = []
+        try:
+            tasks = [(entry, self.import_options) for entry in entries]
+            for result in pool.imap_unordered(_import_assembly, tasks):
+                identifier, stats, elapsed, error = result
+                if error:
+                    self.stderr.write('[{0}] FAILED: {1}'.format(identifier, error))
+                else:
+                    self.stdout.write('[{0}] DONE in {1:.1f} sec.'.format(identifier, elapsed))
+                results.append(result)
+        finally:
+            pool.terminate()
+            pool.join()
+        return results
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Invalid number of arguments.')
+        if not os.path.exists(args[0]):
+            raise CommandError('File {file} not found.'.format(file=args[0]))
+        self.set_options(**options)
+        entries = self.read_manifest(args[0])
+        self.stdout.write('Importing {0} assemblies with {1} processes ...'.format(
+            len(entries), self.processes))
+        # Indexes left dropped by a killed --fast-load import
+        for model in MODELS:
+            for name in restore_indexes(model):
+                self.stdout.write('...\tRestored index {name} ...'.format(name=name))
+        if self.fast_load:
+            with indexes_disabled(Contig), indexes_disabled(Stat), indexes_disabled(Transcript):
+                results = self.import_assemblies(entries)
+        else:
+            results = self.import_assemblies(entries)
+        # Report in manifest order
+        order = dict((e['identifier'], i) for i, e in enumerate(entries))
+        results.sort(key=lambda r: order[r[0]])
+        self.write_summary(results)
+        failed = [r[0] for r in results if r[3]]
+        if failed:
+            raise CommandError('Import failed for: {0}'.format(', '.join(failed)))
+        self.stdout.write('DONE.')
@@ -1,17 +1,68 @@
-import os
+import os, cProfile
+from contextlib import closing
+from functools import partial
+from itertools import chain
+from multiprocessing import Pool
 from optparse import make_option
-from Bio.Blast import NCBIXML
 
 from django.core.management.base import BaseCommand, CommandError
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import connection, transaction
 
-from tasm.models import Assembly, Transcript, Locus, RefSeq, BlastHit, BASE_REFSEQ_URL
+from tasm.blast import (parse_blast_xml, parse_blast_tabular, detect_format, tabular_fields,
+    check_tabular_fields, ParseError, TABULAR_FIELDS)
+from tasm.bulkload import bulk_load, bulk_upsert, indexes_disabled, restore_indexes
+from tasm.cache import invalidate
+from tasm.models import Assembly, AssemblyStats, Locus, Transcript, RefSeq, BlastHit, BASE_REFSEQ_URL
+from tasm.profiling import Profiler
+from tasm.progress import PhaseProgress
+from tasm.parallel import (split_ranges, imap_ordered, xml_iteration_boundary,
+    xml_iteration_span, tabular_boundary, CHUNK_SIZE)
+from tasm.readers import open_input, compression, RangeReader
+from tasm.utils import batches, parse_query_id, TranscriptIndex
+
+# Maximum number of values in a single accession__in lookup
+IN_CHUNK = 500
+
+# Shards of BLAST XML output are a run of <Iteration> elements
+XML_SHARD_HEAD = b'<BlastOutput><BlastOutput_iterations>'
+XML_SHARD_TAIL = b'</BlastOutput_iterations></BlastOutput>'
+
+
+def _xml_worker(args):
+    filename, start, end, expect, max_hits = args
+    with closing(RangeReader(filename, start, end, XML_SHARD_HEAD, XML_SHARD_TAIL)) as fi:
+        return list(parse_blast_xml(fi, expect=expect, max_hits=max_hits))
+
+def _tabular_worker(args):
+    filename, start, end, expect, max_hits, fields = args
+    with closing(RangeReader(filename, start, end)) as fi:
+        return list(parse_blast_tabular(fi, expect=expect, max_hits=max_hits, fields=fields))
 
 
 class Command(BaseCommand):
     '''
     Imports results of the local blast run on assembly's transcripts.fa
-    file.
+    file, either as XML (-outfmt 5) or tabular (-outfmt 6 or 7) output.
+    Tabular output needs the subject title, length and raw score
+    columns; for -outfmt 6 they have to be given with --fields unless
+    they are the ones of blast.TABULAR_FIELDS. The file may be gzip/bgzip, bz2 or xz
+    compressed. It is read incrementally and hits are written in
+    batches, so memory use stays flat regardless of the size of the
+    file. Only hits with an expect value up to --expect are imported.
+    With --workers uncompressed files are split into shards of
+    --chunk-size MB at record boundaries which are parsed in a pool of
+    processes, at most workers + 1 shards ahead of the writes. RefSeqs and
+    hits are still written by this process in file order, so the
+    result is the same as in serial mode.
+
+    An assembly that already has BLAST hits can only be imported again
+    with --mode=replace or --mode=upsert. Both update the hits found in
+    the file and insert the new ones; replace then deletes the hits of
+    the assembly that are not in the file, once all of it has been
+    imported, while upsert leaves them alone.
+    --profile reports wall/CPU time, rows, DB queries and peak RSS for
+    parsing, resolving hits against the database and writing them.
     '''
     option_list = BaseCommand.option_list + (
         make_option('--asm', default='', dest='asm',
@@ -20,11 +71,34 @@ class Command(BaseCommand):
             help='Expect value cutoff'),
         make_option('--max_hits', default='1', dest='max_hits',
             help='Maximum number of hits to import per transcript'),
+        make_option('--format', default='auto', dest='format',
+            choices=('auto', 'xml', 'tabular'),
+            help='Format of the BLAST output: xml, tabular or auto (detect)'),
+        make_option('--fields', default=' '.join(TABULAR_FIELDS), dest='fields',
+            help='Space separated columns of -outfmt 6 output, as given to -outfmt '
+                '(stitle, slen and score are required)'),
+        make_option('--batch-size', default='1000', dest='batch_size',
+            help='Number of BLAST records resolved and written to the database at once'),
+        make_option('--mode', default='insert', dest='mode',
+            choices=('insert', 'replace', 'upsert'),
+            help='insert (the assembly must have no hits), replace or upsert existing hits'),
+        make_option('--workers', default='1', dest='workers',
+            help='Number of processes parsing the (uncompressed) input'),
+        make_option('--chunk-size', default=str(CHUNK_SIZE // 2 ** 20), dest='chunk_size',
+            help='Size (in MB) of the parts of the input parsed by every worker'),
+        make_option('--fast-load', action='store_true', default=False, dest='fast_load',
+            help='Use the native bulk loader of the database backend'),
+        make_option('--mmap', action='store_true', default=False, dest='mmap',
+            help='Memory map the (uncompressed) input file'),
+        make_option('--profile', action='store_true', default=False, dest='profile',
+            help='Report time, rows, queries and memory for every phase'),
+        make_option('--profile-out', default='', dest='profile_out',
+            help='Dump cProfile statistics of the import to this file'),
+        make_option('--profile-json', default='', dest='profile_json',
+            help='Write a JSON summary of the profiled phases to this file'),
         )
-    args = '<blastout.xml>'
-    refseqs = []
-    blasthits = []
-    
+    args = '<blastout.xml|blastout.tsv>'
+
     def set_options(self, **options):
         '''
         Set instance variables based on options dict
@@ -33,6 +107,24 @@ class Command(BaseCommand):
             self.max_hits = int(options['max_hits'])
         except ValueError:
             raise CommandError('max_hits must be integer.')
+        try:
+            self.batch_size = int(options['batch_size'])
+        except ValueError:
+            raise CommandError('batch_size must be integer.')
+        if self.batch_size < 1:
+            raise CommandError('batch_size must be positive.')
+        try:
+            self.workers = int(options['workers'])
+        except ValueError:
+            raise CommandError('workers must be integer.')
+        if self.workers < 1:
+            raise CommandError('workers must be positive.')
+        try:
+            self.chunk_size = int(options['chunk_size']) * 2 ** 20
+        except ValueError:
+            raise CommandError('chunk_size must be integer.')
+        if self.chunk_size < 1:
+            raise CommandError('chunk_size must be positive.')
         try:
             self.expect = float(options['expect'])
         except ValueError:
@@ -41,45 +133,228 @@ class Command(BaseCommand):
             self.asm = Assembly.objects.get(identifier=options['asm'])
         except ObjectDoesNotExist:
             raise CommandError('Unknown assembly: {asm}.'.format(asm=options['asm']))
+        self.mode = options['mode']
+        self.format = options['format']
+        self.fields = options['fields'].split()
+        self.fast_load = options['fast_load']
+        self.use_mmap = options['mmap']
+        self.profile_out = options['profile_out']
+        self.profile_json = options['profile_json']
+        self.profiler = Profiler(
+            options['profile'] or bool(self.profile_out or self.profile_json))
 
-    def _import_blast_record(self, record):
+    def _import_blast_record(self, query, hits):
         '''
-        Handles import of a single BLAST record. Adds records to
-        self.refseqs and self.blasthits to be used in bulk_create
-        later.
-        
-        RefSeq instances are created as needed.
-        BlastHit instances are created in bulk in self.handle()
+        Handles a single BLAST record. Returns a list of (transcript pk,
+        hit) tuples. Queries that match no transcript of the assembly
+        are collected in self.unmatched.
         '''
-        if not record.alignments:
+        if not hits:
+            return []
+        ids = parse_query_id(query)
+        transcript_pk = self.transcripts.get(*ids) if ids else None
+        if transcript_pk is None:
+            self.unmatched.append(query)
+            return []
+        return [(transcript_pk, hit) for hit in hits]
+
+    def _resolve_refseqs(self, hits):
+        '''
+        Makes sure every accession in hits (accession -> Hit) has a
+        RefSeq and its pk in self.refseq_pks. Known accessions are
+        fetched with a single accession__in query per IN_CHUNK values and
+        the missing ones are created with bulk_create.
+        '''
+        missing = [acc for acc in hits if acc not in self.refseq_pks]
+        for chunk in batches(missing, IN_CHUNK):
+            self.refseq_pks.update(
+                RefSeq.objects.filter(accession__in=chunk).values_list('accession', 'pk'))
+        new = [acc for acc in missing if acc not in self.refseq_pks]
+        if not new:
             return
-        query_bits = record.query.split('_')
-        locus = Locus.objects.get(locus_id=int(query_bits[1]), assembly=self.asm)
-        transcript = Transcript.objects.get(
-            locus=locus, 
-            transcript_id=int(query_bits[3].split('/')[0]))
-        i = 0
-        while i < self.max_hits:
-            # FIXME: This is slow because it hits the database (almost)
-            # every iteration. Needs to be improved, not clear how.
-            aln = record.alignments[i]
-            refseq, created = RefSeq.objects.get_or_create(accession=aln.accession,
-                defaults={
-                    'definition': aln.hit_def,
-                    'length': aln.length,
-                    'url': BASE_REFSEQ_URL + aln.accession
-                })
-            self.refseqs.append(refseq)
-            best_hsp = aln.hsps[0]
-            self.blasthits.append(BlastHit(
-                transcript=transcript,
-                refseq=refseq,
-                align_length=best_hsp.align_length,
-                identities=best_hsp.identities,
-                expect=best_hsp.expect,
-                score=best_hsp.score
+        # bulk_create skips RefSeq.save() so url has to be set here
+        RefSeq.objects.bulk_create([RefSeq(
+            accession=acc,
+            definition=hits[acc].definition,
+            length=hits[acc].length,
+            url=BASE_REFSEQ_URL + acc
+            ) for acc in new])
+        for chunk in batches(new, IN_CHUNK):
+            self.refseq_pks.update(
+                RefSeq.objects.filter(accession__in=chunk).values_list('accession', 'pk'))
+        self.num_refseqs += len(new)
+
+    def _import_batch(self, records):
+        '''
+        Resolves the RefSeqs of a batch of BLAST records in a handful
+        of queries and returns the hits as dicts of BlastHit field
+        values.
+        '''
+        hits = []
+        for query, record_hits in records:
+            hits.extend(self._import_blast_record(query, record_hits))
+        self._resolve_refseqs(dict((hit.accession, hit) for pk, hit in hits))
+        return [dict(
+            transcript_id=transcript_pk,
+            refseq_id=self.refseq_pks[hit.accession],
+            align_length=hit.align_length,
+            identities=hit.identities,
+            expect=hit.expect,
+            score=hit.score
+            ) for transcript_pk, hit in hits]
+
+    def _parse(self, handle, blast_file, fmt):
+        '''
+        Iterates over the (query, hits) records of blast_file. With a
+        worker pool the file is split into shards at <Iteration> or
+        query boundaries which are parsed by the workers and chained
+        back in file order. Otherwise handle is parsed right here.
+        '''
+        if self.pool is None:
+            if fmt == 'xml':
+                return parse_blast_xml(handle, expect=self.expect, max_hits=self.max_hits)
+            return parse_blast_tabular(handle,
+                expect=self.expect, max_hits=self.max_hits, fields=self.fields)
+        if fmt == 'xml':
+            span = xml_iteration_span(blast_file)
+            if span is None:
+                return iter([])
+            tasks = [(blast_file, start, end, self.expect, self.max_hits)
+                for start, end in split_ranges(blast_file, xml_iteration_boundary,
+                    chunk_size=self.chunk_size, start=span[0], end=span[1])]
+            worker = _xml_worker
+        else:
+            if 'qseqid' not in self.fields:
+                raise ValueError('Tabular BLAST output has no qseqid column.')
+            boundary = partial(tabular_boundary, query_col=self.fields.index('qseqid'))
+            tasks = [(blast_file, start, end, self.expect, self.max_hits, self.fields)
+                for start, end in split_ranges(blast_file, boundary, chunk_size=self.chunk_size)]
+            worker = _tabular_worker
+        return chain.from_iterable(imap_ordered(self.pool, worker, tasks, self.workers + 1))
+
+    def _import_records(self, records):
+        '''
+        Imports BLAST records in batches of self.batch_size. Every
+        batch is written in its own transaction and dropped right
+        after, so memory use does not grow with the file.
+        '''
+        progress = PhaseProgress('hits', self.stdout)
+        records = batches(records, self.batch_size)
+        while True:
+            with self.profiler.phase('parse') as stats:
+                batch = next(records, None)
+                if batch is None:
+                    break
+                stats.rows += len(batch)
+            with transaction.atomic():
+                with self.profiler.phase('resolve') as stats:
+                    hits = self._import_batch(batch)
+                    stats.rows += len(batch)
+                with self.profiler.phase('write') as stats:
+                    if self.mode != 'insert':
+                        bulk_upsert(BlastHit, hits, ('transcript', 'refseq'))
+                    elif self.fast_load:
+                        bulk_load(BlastHit, hits)
+                    else:
+                        BlastHit.objects.bulk_create([BlastHit(**hit) for hit in hits])
+                    stats.rows += len(hits)
+            if self.imported is not None:
+                self.imported.update((hit['transcript_id'], hit['refseq_id']) for hit in hits)
+            self.num_hits += len(hits)
+            progress.update(len(hits))
+            self.profiler.reset_queries()
+        progress.finish()
+
+    def _delete_stale_hits(self):
+        '''
+        Deletes the hits of the assembly that were not imported from
+        the file (--mode=replace) and returns their number.
+        '''
+        stale = [pk for pk, transcript_pk, refseq_pk in
+            BlastHit.objects.filter(transcript__assembly=self.asm).values_list(
+                'pk', 'transcript_id', 'refseq_id').iterator()
+            if (transcript_pk, refseq_pk) not in self.imported]
+        with transaction.atomic():
+            for chunk in batches(stale, IN_CHUNK):
+                BlastHit.objects.filter(pk__in=chunk).delete()
+        return len(stale)
+
+    def run(self, blast_file):
+        self.stdout.write('Importing BLAST results for assembly %s ...' % self.asm)
+        # Indexes left dropped by a killed --fast-load import
+        restore_indexes(BlastHit)
+        existing = BlastHit.objects.filter(transcript__assembly=self.asm)
+        if self.mode == 'insert' and existing.exists():
+            raise CommandError(
+                'Assembly {asm} already has BLAST hits, use --mode=replace or --mode=upsert.'.format(
+                    asm=self.asm))
+        # accession -> RefSeq pk for every accession seen so far
+        self.refseq_pks = {}
+        # (transcript pk, RefSeq pk) of the hits written by --mode=replace
+        self.imported = set() if self.mode == 'replace' else None
+        self.unmatched = []
+        self.num_hits = self.num_refseqs = 0
+        # Transcripts imported before Transcript.assembly was stored
+        n = Transcript.objects.set_assembly(self.asm)
+        if n:
+            self.stdout.write('...\tSet the assembly of {n} transcripts ...'.format(n=n))
+        with self.profiler.phase('index') as stats:
+            self.transcripts = TranscriptIndex(
+                Transcript.objects.filter(assembly=self.asm).values_list(
+                    'locus__locus_id', 'transcript_id', 'pk').iterator())
+            stats.rows = len(self.transcripts)
+        fmt = self.format
+        if fmt == 'auto':
+            with closing(open_input(blast_file)) as fi:
+                fmt = detect_format(fi.read(1024))
+        if fmt == 'tabular':
+            with closing(open_input(blast_file)) as fi:
+                self.fields = tabular_fields(fi, self.fields)
+            try:
+                check_tabular_fields(self.fields)
+            except ValueError as e:
+                raise CommandError(str(e))
+        self.pool = None
+        if self.workers > 1 and not compression(blast_file):
+            # Don't share the database connection with the workers
+            connection.close()
+            self.pool = Pool(self.workers)
+        try:
+            with closing(open_input(blast_file, use_mmap=self.use_mmap)) as fi:
+                try:
+                    records = self._parse(fi, blast_file, fmt)
+                    if self.fast_load:
+                        with indexes_disabled(BlastHit):
+                            self._import_records(records)
+                    else:
+                        self._import_records(records)
+                except (ValueError, ParseError) as e:
+                    raise CommandError('Malformed BLAST output: {0}'.format(e))
+            if self.mode == 'replace':
+                with self.profiler.phase('delete') as stats:
+                    stats.rows = self._delete_stale_hits()
+        finally:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool.join()
+            # Batches committed before a failure are counted as well
+            with self.profiler.phase('summaries'):
+                Transcript.objects.refresh_num_hits(self.asm)
+                Locus.objects.refresh_summaries(self.asm)
+                AssemblyStats.objects.refresh(self.asm)
+            invalidate(self.asm.pk)
+        # refseq_pks holds exactly the accessions of the imported hits
+        self.stdout.write('Accepted {hits} hits for {seqs} sequences ({new} new).'.format(
+            hits=self.num_hits,
+            seqs=len(self.refseq_pks),
+            new=self.num_refseqs
             ))
-            i += 1
+        if self.unmatched:
+            self.stderr.write('Skipped {n} queries with no matching transcript in {asm}, e.g. {first}'.format(
+                n=len(self.unmatched),
+                asm=self.asm,
+                first=', '.join(self.unmatched[:5])
+                ))
 
     def handle(self, *args, **options):
         if len(args) != 1:
@@ -88,14 +363,16 @@ class Command(BaseCommand):
         if not os.path.exists(blast_file):
             raise CommandError('File {file} not found.'.format(file=blast_file))
         self.set_options(**options)
-        self.stdout.write('Importing BLAST results for assembly %s ...' % self.asm)
-        with open(blast_file, 'rU') as fi:
-            for rec in NCBIXML.parse(fi):
-                self._import_blast_record(rec)
-        self.stdout.write('Accepted {hits} for {seqs} sequences.'.format(
-            hits=len(self.blasthits),
-            seqs=len(self.refseqs)
-            ))
-        self.stdout.write('Importing BLAST hits ...')
-        BlastHit.objects.bulk_create(self.blasthits)
+        if self.profile_out:
+            profile = cProfile.Profile()
+            try:
+                profile.runcall(self.run, blast_file)
+            finally:
+                profile.dump_stats(self.profile_out)
+        else:
+            self.run(blast_file)
+        self.profiler.report(self.stdout)
+        if self.profile_json:
+            self.profiler.dump_json(self.profile_json,
+                command='import_blast', assembly=self.asm.identifier)
         self.stdout.write('DONE.')
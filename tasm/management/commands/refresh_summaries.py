@@ -0,0 +1,53 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from tasm.cache import invalidate
+from tasm.models import Assembly, AssemblyStats, Locus, Transcript, BestTranscript, BEST_CUTOFFS
+
+
+class Command(BaseCommand):
+    '''
+    Recomputes the precomputed summaries of the given assemblies (all
+    of them if none is given): the assembly and the number of BLAST
+    hits of the transcripts, the best transcript of every locus for the
+    cutoffs in settings.TASM_BEST_CUTOFFS or --cutoffs and the summary
+    columns of the loci and the assembly statistics.
+    '''
+    option_list = BaseCommand.option_list + (
+        make_option('--cutoffs', default='', dest='cutoffs',
+            help='Comma separated length cutoffs (%) of the best transcripts, e.g. 80,90'),
+        )
+    args = '[<assembly identifier> ...]'
+
+    def set_options(self, **options):
+        '''
+        Set instance variables based on options dict
+        '''
+        self.cutoffs = BEST_CUTOFFS
+        if options['cutoffs']:
+            try:
+                self.cutoffs = [int(c) for c in options['cutoffs'].split(',')]
+            except ValueError:
+                raise CommandError('cutoffs must be integers.')
+        if any(c < 0 or c > 100 for c in self.cutoffs):
+            raise CommandError('cutoffs must be between 0 and 100.')
+
+    def handle(self, *args, **options):
+        self.set_options(**options)
+        assemblies = Assembly.objects.all()
+        if args:
+            assemblies = assemblies.filter(identifier__in=args)
+            missing = set(args) - set(asm.identifier for asm in assemblies)
+            if missing:
+                raise CommandError('Unknown assembly: {asm}.'.format(asm=', '.join(sorted(missing))))
+        for asm in assemblies:
+            Transcript.objects.set_assembly(asm)
+            self.stdout.write('Selecting best transcripts for assembly {asm} ...'.format(asm=asm))
+            BestTranscript.objects.refresh(asm, self.cutoffs)
+            self.stdout.write('Summarizing loci for assembly {asm} ...'.format(asm=asm))
+            Transcript.objects.refresh_num_hits(asm)
+            Locus.objects.refresh_summaries(asm)
+            AssemblyStats.objects.refresh(asm)
+            invalidate(asm.pk)
+        self.stdout.write('DONE.')
@@ -1,17 +1,120 @@
-import os, csv
+import os, csv, cProfile
+from contextlib import closing
+from itertools import chain, islice
+from multiprocessing import Pool
 from optparse import make_option
-from Bio import SeqIO
 
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
 
-from tasm.models import Assembly, Contig, Stat, Transcript, Locus
-from tasm.utils import get_contig_ids
+from tasm.bulkload import bulk_load, indexes_disabled, restore_indexes
+from tasm.cache import invalidate
+from tasm.models import (Assembly, ImportPhase, Contig, Stat, Transcript, Locus,
+    BestTranscript, AssemblyStats)
+from tasm.parallel import split_ranges, imap_ordered, NullLock, CHUNK_SIZE
+from tasm.profiling import Profiler
+from tasm.progress import PhaseProgress
+from tasm.readers import read_fasta, open_input, find_input, compression
+from tasm.utils import parse_header, get_contig_ids, batches, build_coverage_index, transcript_coverage
 
 CONTIG_FILE = 'contigs.fa'
 CONTIGORDERING_FILE = 'contig-ordering.txt'
 STATS_FILE = 'stats.txt'
 TRANSCRIPTS_FILE = 'transcripts.fa'
-    
+
+# Number of transcripts per vectorized coverage computation
+COVERAGE_BATCH = 10000
+
+
+#
+# The parsing functions below are module level so that they can run
+# either in the command's process or in worker processes, each
+# handling the records in the start:end byte range of the file.
+#
+
+def parse_contigs(filename, use_mmap=False, start=0, end=None):
+    '''
+    contigs.fa is just a FASTA file with NODE headers. Yields a dict
+    of Contig field values per record.
+    '''
+    for header, seq in read_fasta(filename, use_mmap=use_mmap, start=start, end=end):
+        fields = parse_header(header)
+        try:
+            yield dict(
+                node_id=int(fields['node_id']),
+                length=int(fields['length']),
+                coverage=float(fields['coverage']),
+                sequence=seq
+            )
+        except (KeyError, ValueError):
+            raise CommandError('Bad header in {file}: {header}'.format(
+                file=CONTIG_FILE, header=header))
+
+
+def parse_transcripts(filename, use_mmap=False, start=0, end=None):
+    '''
+    transcripts.fa is a FASTA file with Locus/Transcript headers.
+    Yields a dict of Transcript field values per record, with locus
+    set to the locus id from the header.
+    '''
+    for header, seq in read_fasta(filename, use_mmap=use_mmap, start=start, end=end):
+        fields = parse_header(header)
+        try:
+            yield dict(
+                locus=int(fields['locus']),
+                transcript_id=int(fields['transcript_id']),
+                confidence=float(fields['confidence']),
+                length=int(fields['length']),
+                sequence=seq
+            )
+        except (KeyError, ValueError):
+            raise CommandError('Bad header in {file}: {header}'.format(
+                file=TRANSCRIPTS_FILE, header=header))
+
+
+def parse_coverage(filename, coverage_index, use_mmap=False, start=0, end=None):
+    '''
+    Parses contig-ordering.txt as a FASTA file and yields a tuple per
+    transcript where the first element is locus id, the second is the
+    transcript id and the third value is the transcript coverage,
+    computed in vectorized batches from coverage_index.
+    '''
+    def _records():
+        for header, seq in read_fasta(filename, use_mmap=use_mmap, start=start, end=end):
+            fields = parse_header(header)
+            # Only process records that correspond to a reported
+            # transcripts
+            if fields.get('transcript_id'):
+                yield (
+                    int(fields['locus']),
+                    int(fields['transcript_id']),
+                    get_contig_ids(seq),
+                )
+    for batch in batches(_records(), COVERAGE_BATCH):
+        coverage = transcript_coverage(coverage_index, [rec[2] for rec in batch])
+        for rec, cov in zip(batch, coverage):
+            yield rec[0], rec[1], float(cov)
+
+
+_coverage_index = None
+
+def _init_worker(coverage_index):
+    global _coverage_index
+    _coverage_index = coverage_index
+
+def _contigs_worker(args):
+    filename, start, end = args
+    return list(parse_contigs(filename, start=start, end=end))
+
+def _transcripts_worker(args):
+    filename, start, end = args
+    return list(parse_transcripts(filename, start=start, end=end))
+
+def _coverage_worker(args):
+    filename, start, end = args
+    return list(parse_coverage(filename, _coverage_index, start=start, end=end))
+
+
 class Command(BaseCommand):
     '''
     Imports the files produced by oases pipeline.
@@ -24,7 +127,35 @@ class Command(BaseCommand):
         - the trancripts.fa is processed setting up the Locus table and
         calculating each transcript coverage by examining the trancript
         composition in contig-ordering.txt and pulling in the coverage
-        info for each contig from the Stat table.
+        info for each contig from an in-memory node coverage index
+        built from stats.txt.
+        - the best transcript of every locus is stored in BestTranscript
+        for the cutoffs in settings.TASM_BEST_CUTOFFS and the summary
+        columns of the loci and the assembly statistics are computed
+    Every phase is streamed: records are parsed, transformed and
+    written in batches of --batch-size rows inside a transaction, so
+    memory use does not depend on the size of the assembly.
+    With --workers the FASTA files are split into byte ranges of
+    --chunk-size MB at record boundaries and parsed (and transcript
+    coverage computed) in a pool of processes. Results are merged back
+    in file order, so the rows written are the same as in a serial
+    run. At most workers + 1 ranges per file are parsed ahead of the
+    database writes.
+    With --fast-load Contig, Stat and Transcript rows skip the ORM and
+    go through the database's native bulk loader (see tasm.bulkload),
+    with the secondary indexes of the table rebuilt after the load.
+    Input files may be gzip/bgzip, bz2 or xz compressed (e.g.
+    transcripts.fa.gz) and are decompressed on the fly; --mmap and
+    --workers only apply to uncompressed files.
+    Every batch is committed together with an ImportPhase checkpoint
+    (loci are written in the same transaction as their transcripts).
+    An interrupted import can be continued with --resume, which skips
+    completed phases and the rows already loaded in the current one.
+    Indexes dropped by an interrupted --fast-load import are recreated
+    when the next import starts.
+    --profile reports wall/CPU time, rows, rows/sec, DB queries and
+    peak RSS separately for parsing and DB writes of every phase
+    (transcripts:parse includes the transcripts:coverage time).
     '''
     option_list = BaseCommand.option_list + (
         make_option('--species', default='', dest='species',
@@ -35,8 +166,33 @@ class Command(BaseCommand):
             help='K max'),
         make_option('--dir', default='', dest='dir',
             help='oases output directory'),
+        make_option('--batch-size', default='5000', dest='batch_size',
+            help='Number of rows written to the database per batch'),
+        make_option('--mmap', action='store_true', default=False, dest='mmap',
+            help='Memory map FASTA input files instead of buffered reads'),
+        make_option('--workers', default='1', dest='workers',
+            help='Number of processes used to parse the FASTA files'),
+        make_option('--chunk-size', default=str(CHUNK_SIZE // 2 ** 20), dest='chunk_size',
+            help='Size (in MB) of the parts of the input parsed by every worker'),
+        make_option('--fast-load', action='store_true', default=False, dest='fast_load',
+            help='Use the native bulk loader of the database backend'),
+        make_option('--resume', action='store_true', default=False, dest='resume',
+            help='Resume an interrupted import of the assembly'),
+        make_option('--profile', action='store_true', default=False, dest='profile',
+            help='Report time, rows, queries and memory for every phase'),
+        make_option('--profile-out', default='', dest='profile_out',
+            help='Dump cProfile statistics of the import to this file'),
+        make_option('--profile-json', default='', dest='profile_json',
+            help='Write a JSON summary of the profiled phases to this file'),
         )
     args = '<assembly identifier>'
+    # Held around every batch written to the database, import_assemblies
+    # replaces it with a semaphore shared by concurrent imports
+    write_lock = NullLock()
+    # Whether indexes are restored at the start and dropped for
+    # --fast-load by this command. import_assemblies does it once around
+    # all the concurrent imports instead.
+    manage_indexes = True
     
     def set_options(self, **options):
         '''
@@ -47,6 +203,12 @@ class Command(BaseCommand):
             self.dir = dir
         else:
             raise CommandError('Directory %s does not exist.' % dir)
+        self.files = {}
+        for name in (CONTIG_FILE, CONTIGORDERING_FILE, STATS_FILE, TRANSCRIPTS_FILE):
+            path = find_input(dir, name)
+            if path is None:
+                raise CommandError('File {file} not found in {dir}.'.format(file=name, dir=dir))
+            self.files[name] = path
         try:
             k_min = int(options['k_min'])
             k_max = int(options['k_max'])
@@ -58,141 +220,306 @@ class Command(BaseCommand):
         else:
             raise CommandError('k_max must be greater than k_min.')
         self.species = options['species']
+        try:
+            self.batch_size = int(options['batch_size'])
+        except ValueError:
+            raise CommandError('batch_size must be integer.')
+        if self.batch_size < 1:
+            raise CommandError('batch_size must be positive.')
+        self.use_mmap = options['mmap']
+        try:
+            self.workers = int(options['workers'])
+        except ValueError:
+            raise CommandError('workers must be integer.')
+        if self.workers < 1:
+            raise CommandError('workers must be positive.')
+        try:
+            self.chunk_size = int(options['chunk_size']) * 2 ** 20
+        except ValueError:
+            raise CommandError('chunk_size must be integer.')
+        if self.chunk_size < 1:
+            raise CommandError('chunk_size must be positive.')
+        self.fast_load = options['fast_load']
+        self.resume = options['resume']
+        self.profile_out = options['profile_out']
+        self.profile_json = options['profile_json']
+        self.profiler = Profiler(
+            options['profile'] or bool(self.profile_out or self.profile_json))
 
     def create_asm(self, id):
-        asm, created = Assembly.objects.get_or_create(
-            identifier=id,
-            k_min=self.k_min,
-            k_max=self.k_max
-            )
-        if created:
-            self.asm = asm
-        else:
+        try:
+            asm = Assembly.objects.get(identifier=id)
+        except Assembly.DoesNotExist:
+            self.asm = Assembly.objects.create(
+                identifier=id,
+                species=self.species,
+                k_min=self.k_min,
+                k_max=self.k_max
+                )
+            return
+        if not self.resume:
             raise CommandError('Assembly identifier must be unique')
-            
-    def import_contigs(self):
+        if not asm.importphase_set.exists():
+            raise CommandError('No import checkpoint recorded for assembly {asm}.'.format(asm=asm))
+        if (asm.k_min, asm.k_max) != (self.k_min, self.k_max):
+            raise CommandError('k_min and k_max do not match assembly {asm}.'.format(asm=asm))
+        self.asm = asm
+
+    def _parse(self, parse, worker, filename, *args):
         '''
-        contigs.fa is just a FASTA file so we use biopython's parser
-        to handle it
-        '''
-        contig_fname = os.path.join(self.dir, CONTIG_FILE)
-        contigs = []
-        with open(contig_fname, 'rU') as fi:
-            for rec in SeqIO.parse(fi, 'fasta'):
-                # TODO: Need to check here for a bad header!
-                bits = rec.id.split('_')
-                contigs.append(Contig(
-                    assembly=self.asm,
-                    sequence=rec.seq,
-                    node_id=bits[1],
-                    length=bits[3],
-                    coverage=bits[5]
-                ))
-        return Contig.objects.bulk_create(contigs)
+        Iterates over the records of filename produced by parse. With
+        a worker pool the file is split into byte ranges which are
+        handed to worker and the results chained back in file order.
+        Compressed files can't be split and are always parsed here.
+        '''
+        if self.pool is None or compression(filename):
+            return parse(filename, *args, use_mmap=self.use_mmap)
+        ranges = [(filename, start, end) for start, end in split_ranges(filename, chunk_size=self.chunk_size)]
+        return chain.from_iterable(
+            imap_ordered(self.pool, worker, ranges, self.workers + 1))
 
-    def import_stats(self):
-        import csv
-        stats_filename = os.path.join(self.dir, STATS_FILE)
-        stats = []
-        with open(stats_filename, 'rU') as fi:
+    def _write_batches(self, model, rows, checkpoint, prepare=None):
+        progress = PhaseProgress(checkpoint.phase, self.stdout)
+        if checkpoint.rows:
+            self.stdout.write('...\tResuming {phase} after {rows} rows ...'.format(
+                phase=checkpoint.phase, rows=checkpoint.rows))
+            rows = islice(rows, checkpoint.rows, None)
+        rows = batches(rows, self.batch_size)
+        while True:
+            with self.profiler.phase(checkpoint.phase + ':parse') as stats:
+                batch = next(rows, None)
+                if batch is None:
+                    break
+                stats.rows += len(batch)
+            with self.profiler.phase(checkpoint.phase + ':write') as stats:
+                with self.write_lock:
+                    with transaction.atomic():
+                        if prepare is not None:
+                            batch = prepare(batch)
+                        if self.fast_load:
+                            bulk_load(model, batch)
+                        else:
+                            model.objects.bulk_create([model(**row) for row in batch])
+                        checkpoint.rows += len(batch)
+                        checkpoint.save(update_fields=['rows'])
+                stats.rows += len(batch)
+            progress.update(len(batch))
+            # Don't let DEBUG query logging grow with the assembly
+            self.profiler.reset_queries()
+        checkpoint.completed = True
+        checkpoint.save(update_fields=['completed'])
+        progress.finish()
+        self.phase_stats.append((checkpoint.phase, progress.rows, progress.elapsed))
+        return checkpoint.rows
+
+    def _bulk_import(self, model, rows, phase, prepare=None):
+        '''
+        Writes rows (dicts of field values keyed by attname) to the
+        model table in batches of self.batch_size. Every batch is
+        committed in its own transaction together with the phase
+        checkpoint. If given, prepare is called on every batch to
+        transform it before it is written.
+        Returns the total number of rows loaded in the phase.
+        '''
+        checkpoint, created = ImportPhase.objects.get_or_create(
+            assembly=self.asm, phase=phase)
+        if checkpoint.completed:
+            self.stdout.write('...\t{phase} already imported, skipping ...'.format(phase=phase))
+            return checkpoint.rows
+        if self.fast_load and self.manage_indexes:
+            # Index changes may commit implicitly (MySQL) so they have
+            # to wrap the transactions, not the other way round
+            with indexes_disabled(model):
+                return self._write_batches(model, rows, checkpoint, prepare)
+        return self._write_batches(model, rows, checkpoint, prepare)
+
+    def _iter_contigs(self):
+        contig_fname = self.files[CONTIG_FILE]
+        for fields in self._parse(parse_contigs, _contigs_worker, contig_fname):
+            fields['assembly_id'] = self.asm.pk
+            yield fields
+
+    def import_contigs(self):
+        return self._bulk_import(Contig, self._iter_contigs(), 'contigs')
+
+    def _iter_stats(self):
+        with closing(open_input(self.files[STATS_FILE])) as fi:
             reader = csv.DictReader(fi, delimiter='\t')
             for rec in reader:
                 if rec['long_cov'] != 'Inf':
-                    stats.append(Stat(
-                        assembly=self.asm,
-                        node_id=rec['ID'],
-                        length=rec['lgth'],
-                        coverage=rec['long_cov']
-                    ))
-        return Stat.objects.bulk_create(stats)
-
-    def _build_contig_ordering(self):
-        '''
-        Parses contig-ordering.txt file as a FASTA file and builds a
-        list of tuples where the first element is locus id, the second
-        is the transcript id and the third value is the list of
-        node ids for the transcript.
-        '''
-        filename = os.path.join(self.dir, CONTIGORDERING_FILE)
-        contigs = []
-        self.stdout.write('Processing %s ...' % CONTIGORDERING_FILE)
-        with open(filename, 'rU') as fi:
-            for rec in SeqIO.parse(fi, 'fasta'):
-                bits = rec.id.split('_')
-                # Only process records that correspond to a reported
-                # transcripts
-                if 'Transcript' in bits:
-                    contigs.append((
-                        int(bits[1]),
-                        int(bits[3].split('/')[0]),
-                        get_contig_ids(rec.seq),
-                    ))
-        return contigs
-
-    def _compute_coverage(self, contig_ids):
-        '''
-        Computes the coverage of the transcript made up from contig_ids
-        as a geometric mean of the coverage for each contig.
-        '''
-        from scipy.stats import gmean
-        filter = {'assembly': self.asm, 'node_id__in': contig_ids,}
-        values = Stat.objects.filter(**filter).values_list('coverage', flat=True)
-        return gmean(values)
+                    yield dict(
+                        assembly_id=self.asm.pk,
+                        node_id=int(rec['ID']),
+                        length=int(rec['lgth']),
+                        coverage=float(rec['long_cov'])
+                    )
+
+    def import_stats(self):
+        return self._bulk_import(Stat, self._iter_stats(), 'stats')
+
+    def _build_coverage_index(self):
+        '''
+        Builds node id -> coverage array from stats.txt so transcript
+        coverage can be computed without querying the Stat table.
+        '''
+        with closing(open_input(self.files[STATS_FILE])) as fi:
+            return build_coverage_index(fi)
+
+    def _iter_transcripts(self):
+        '''
+        Yields a dict per transcript in transcripts.fa with the coverage
+        of the transcript computed from contig-ordering.txt.
+
+        Both files list transcripts in the same order, so they are
+        read side by side in a single pass. Records are matched on
+        (locus_id, transcript_id) and any misalignment between the
+        two files is an error.
+        '''
+        filename = self.files[TRANSCRIPTS_FILE]
+        ordering = iter(self._parse(parse_coverage, _coverage_worker,
+            self.files[CONTIGORDERING_FILE], self.coverage_index))
+        for t in self._parse(parse_transcripts, _transcripts_worker, filename):
+            key = (t['locus'], t['transcript_id'])
+            try:
+                with self.profiler.phase('transcripts:coverage') as stats:
+                    locus_id, transcript_id, coverage = next(ordering)
+                    stats.rows += 1
+            except StopIteration:
+                raise CommandError('{file} has no entry for Locus {loc} Transcript {t}.'.format(
+                    file=CONTIGORDERING_FILE, loc=key[0], t=key[1]))
+            if key != (locus_id, transcript_id):
+                raise CommandError(
+                    'Locus {0} Transcript {1} does not match Locus {loc} Transcript {t} in {file}.'.format(
+                        key[0],
+                        key[1],
+                        loc=locus_id,
+                        t=transcript_id,
+                        file=CONTIGORDERING_FILE
+                        ))
+            t['coverage'] = coverage
+            yield t
+        for locus_id, transcript_id, coverage in ordering:
+            raise CommandError('{file} has no entry for Locus {loc} Transcript {t}.'.format(
+                file=TRANSCRIPTS_FILE, loc=locus_id, t=transcript_id))
+
+    def _create_loci(self, locus_ids):
+        '''
+        Creates loci that have not been seen yet and adds their pk
+        values to self.locus_pks (locus_id -> pk).
+        '''
+        new_ids = set(locus_ids) - set(self.locus_pks)
+        if not new_ids:
+            return
+        Locus.objects.bulk_create([Locus(locus_id=loc_id, assembly=self.asm) for loc_id in sorted(new_ids)])
+        # transcripts.fa is sorted by locus so a range lookup picks up
+        # the new loci without a huge IN clause
+        created = Locus.objects.filter(
+            assembly=self.asm,
+            locus_id__range=(min(new_ids), max(new_ids))
+            ).values_list('locus_id', 'pk')
+        self.locus_pks.update((loc_id, pk) for loc_id, pk in created if loc_id in new_ids)
+
+    def _prepare_transcripts(self, batch):
+        '''
+        Creates the loci for a batch of transcripts and sets locus_id
+        of every transcript to the locus pk.
+        '''
+        self._create_loci(t['locus'] for t in batch)
+        for t in batch:
+            t['locus_id'] = self.locus_pks[t.pop('locus')]
+            t['assembly_id'] = self.asm.pk
+        return batch
 
     def process_transcripts(self):
         '''
-        transcripts.fa is a FASTA file so we use biopython's
-        fasta parser to handle it.
-        
-        This only hits database three times.
+        Streams transcripts.fa, creating loci and transcripts a batch
+        at a time. Every batch hits the database at most three times
+        and transcripts are matched to locus pk values through the
+        self.locus_pks dict, so the phase is linear in the number of
+        transcripts.
         '''
-        filename = os.path.join(self.dir, TRANSCRIPTS_FILE)
-        transcripts = []
-        loci = []
-        contig_ordering = self._build_contig_ordering()
+        # Loci committed by an interrupted import are picked up here
+        self.locus_pks = dict(
+            Locus.objects.filter(assembly=self.asm).values_list('locus_id', 'pk'))
         self.stdout.write('Importing transcripts and calculating coverage...')
-        with open(filename, 'rU') as fi:
-            # Parse through fasta file, create loci and transcripts
-            # Compute coverage for transcripts
-            for i, rec in enumerate(SeqIO.parse(fi, 'fasta')):
-                # TODO: check for a bad header!
-                bits = rec.id.split('_')
-                loci.append(int(bits[1]))
-                transcripts.append(dict(
-                    locus=int(bits[1]),
-                    transcript_id=int(bits[3].split('/')[0]),
-                    confidence=bits[5],
-                    length=bits[7],
-                    sequence=rec.seq,
-                    coverage=self._compute_coverage(contig_ordering[i][2])
-                ))
-        self.stdout.write('Done calculating coverage...')
-        created_loci = Locus.objects.bulk_create([Locus(locus_id=loc_id, assembly=self.asm) for loc_id in set(loci)])
-        self.stdout.write('...\tProcessed %d loci ...' % len(created_loci))
-        # Assign appropriate locus pk values to matching transcripts
-        loci = Locus.objects.filter(assembly=self.asm).values_list('pk', 'locus_id')
-        for t in transcripts:
-            for pk, loc_id in loci:
-                if t['locus'] == loc_id:
-                    del t['locus']
-                    t['locus_id'] = pk
-                    break
-        return Transcript.objects.bulk_create([Transcript(**kwargs) for kwargs in transcripts])
-        
+        n = self._bulk_import(Transcript, self._iter_transcripts(),
+            'transcripts', prepare=self._prepare_transcripts)
+        self.stdout.write('...\tProcessed %d loci ...' % len(self.locus_pks))
+        return n
+
+    def restore_indexes(self):
+        '''
+        Recreates the indexes a killed --fast-load import left dropped.
+        '''
+        with self.write_lock:
+            for model in (Contig, Stat, Transcript):
+                for name in restore_indexes(model):
+                    self.stdout.write('...\tRestored index {name} ...'.format(name=name))
+
+    def run(self, identifier):
+        with self.profiler.phase('coverage index') as stats:
+            self.coverage_index = self._build_coverage_index()
+            stats.rows = len(self.coverage_index)
+        # (phase, rows, seconds) for every phase run by this command
+        self.phase_stats = []
+        self.pool = None
+        if self.workers > 1:
+            # Workers never touch the database, make sure they don't
+            # inherit an open connection either
+            connection.close()
+            self.pool = Pool(self.workers, _init_worker, (self.coverage_index,))
+        self.asm = None
+        try:
+            if self.manage_indexes:
+                self.restore_indexes()
+            self.stdout.write('Creating new assembly ...')
+            self.create_asm(identifier)
+            self.stdout.write('Populating Contig table ...')
+            n = self.import_contigs()
+            self.stdout.write('...\tImported %d contigs ...' % n)
+            self.stdout.write('Populating Stat table ...')
+            n = self.import_stats()
+            self.stdout.write('...\tImported %d nodes ...' % n)
+            self.stdout.write('Processing transcripts ...')
+            n = self.process_transcripts()
+            self.stdout.write('...\tProcessed %d transcripts ...' % n)
+            # Transcripts resumed from an import made before
+            # Transcript.assembly was stored
+            with self.write_lock:
+                m = Transcript.objects.set_assembly(self.asm)
+            if m:
+                self.stdout.write('...\tSet the assembly of %d transcripts ...' % m)
+            self.stdout.write('Selecting best transcripts ...')
+            with self.profiler.phase('best transcripts'):
+                with self.write_lock:
+                    BestTranscript.objects.refresh(self.asm)
+            with self.profiler.phase('summaries'):
+                with self.write_lock:
+                    Locus.objects.refresh_summaries(self.asm)
+                    AssemblyStats.objects.refresh(self.asm)
+        finally:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool.join()
+            # Also after a failed import, which may have written part
+            # of the assembly
+            if self.asm is not None:
+                invalidate(self.asm.pk)
 
     def handle(self, *args, **options):
         if len(args) != 1:
             raise CommandError('Invalid number of arguments.')
         self.set_options(**options)
-        self.stdout.write('Creating new assembly ...')
-        self.create_asm(args[0])
-        self.stdout.write('Populating Contig table ...')
-        n = self.import_contigs()
-        self.stdout.write('...\tImported %d contigs ...' % len(n))
-        self.stdout.write('Populating Stat table ...')
-        n = self.import_stats()
-        self.stdout.write('...\tImported %d nodes ...' % len(n))
-        self.stdout.write('Processing transcripts ...')
-        n = self.process_transcripts()
-        self.stdout.write('...\tProcessed %d transcripts ...' % len(n))
+        if self.profile_out:
+            profile = cProfile.Profile()
+            try:
+                profile.runcall(self.run, args[0])
+            finally:
+                profile.dump_stats(self.profile_out)
+        else:
+            self.run(args[0])
+        self.profiler.report(self.stdout)
+        if self.profile_json:
+            self.profiler.dump_json(self.profile_json,
+                command='setup_database', assembly=args[0])
         self.stdout.write('DONE.')
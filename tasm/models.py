@@ -1,9 +1,23 @@
 from __future__ import division
-from django.db import models
-from django.db.models import Min, Max
+from django.conf import settings
+from django.db import models, connections, transaction
+from django.db.models import Min, Max, Count, Sum
+
+import numpy as np
+
+from tasm.queries import (best_transcripts_sql, materialize_best_sql, locus_summary_sql,
+    transcript_hits_sql)
+from tasm.utils import n50
 
 BASE_REFSEQ_URL = 'http://www.ncbi.nlm.nih.gov/nuccore/'
 
+# Length cutoffs (in % of the longest transcript in a locus) for which
+# the best transcripts are precomputed
+BEST_CUTOFFS = getattr(settings, 'TASM_BEST_CUTOFFS', (80,))
+
+# Number of bases of the transcript sequence shown on list pages
+SEQUENCE_PREVIEW = 60
+
 class Assembly(models.Model):
     '''
     Container class to hold loci and transcripts from a single
@@ -25,13 +39,121 @@ class Assembly(models.Model):
         return ('tasm_loci_for_asm_view', None, {'asm_pk': self.pk})
 
 
+class AssemblyStatsManager(models.Manager):
+
+    def refresh(self, asm):
+        '''
+        Recomputes the statistics of the assembly. Counts are summed up
+        from the Locus summary columns and orphans are counted with
+        Transcript.num_hits, so LocusManager.refresh_summaries and
+        TranscriptManager.refresh_num_hits must have been run first.
+        '''
+        stats, created = self.get_or_create(assembly=asm)
+        totals = Locus.objects.filter(assembly=asm).aggregate(
+            num_loci=Count('pk'),
+            num_transcripts=Sum('num_transcripts'),
+            num_hits=Sum('num_hits'))
+        stats.num_loci = totals['num_loci']
+        stats.num_transcripts = totals['num_transcripts'] or 0
+        stats.num_hits = totals['num_hits'] or 0
+        stats.num_refseqs = BlastHit.objects.filter(transcript__assembly=asm).values(
+            'refseq').distinct().count()
+        lengths = np.fromiter(Transcript.objects.filter(assembly=asm).values_list(
+            'length', flat=True).iterator(), dtype=np.int64)
+        stats.total_length = int(lengths.sum())
+        stats.n50 = n50(lengths)
+        stats.num_orphans = BestTranscript.objects.filter(
+            assembly=asm, cutoff=BEST_CUTOFFS[0], transcript__num_hits=0).count()
+        stats.save()
+        return stats
+
+
+class AssemblyStats(models.Model):
+    '''
+    Summary statistics of an assembly for the home page: counts of
+    loci, transcripts, BLAST hits and the RefSeqs they hit, N50 and
+    total length of the transcripts and the number of best transcripts
+    (for the first of BEST_CUTOFFS) without BLAST hits. Refreshed by
+    the import commands.
+    '''
+    assembly = models.OneToOneField(Assembly, related_name='stats')
+    num_loci = models.PositiveIntegerField('Loci', default=0)
+    num_transcripts = models.PositiveIntegerField('Transcripts', default=0)
+    num_hits = models.PositiveIntegerField('BLAST hits', default=0)
+    num_refseqs = models.PositiveIntegerField('RefSeqs', default=0)
+    num_orphans = models.PositiveIntegerField('Best transcripts without hits', default=0)
+    total_length = models.BigIntegerField('Total transcript length', default=0)
+    n50 = models.PositiveIntegerField('N50', default=0)
+    updated = models.DateTimeField('Updated', auto_now=True)
+
+    objects = AssemblyStatsManager()
+
+    class Meta:
+        verbose_name_plural = 'assembly stats'
+
+    def __unicode__(self):
+        return '{asm} stats'.format(asm=self.assembly)
+
+
+class ImportPhase(models.Model):
+    '''
+    Progress of a single setup_database phase (contigs, stats,
+    transcripts) for an assembly. rows is updated in the same
+    transaction as every batch written, so an interrupted import can
+    be resumed from the last committed batch.
+    '''
+    assembly = models.ForeignKey(Assembly)
+    phase = models.CharField('Phase', max_length=20)
+    rows = models.PositiveIntegerField('Rows loaded', default=0)
+    completed = models.BooleanField('Completed', default=False)
+
+    class Meta:
+        unique_together = (('assembly', 'phase',),)
+
+    def __unicode__(self):
+        return '{asm}:{phase} ({rows})'.format(
+            asm=self.assembly,
+            phase=self.phase,
+            rows=self.rows
+            )
+
+
+class LocusManager(models.Manager):
+
+    def refresh_summaries(self, asm):
+        '''
+        Recomputes the summary columns of all loci of the assembly in a
+        single UPDATE. The best transcript is the one stored for the
+        first of BEST_CUTOFFS, which is selected first if missing.
+        '''
+        cutoff = BEST_CUTOFFS[0]
+        if not BestTranscript.objects.has_cutoff(asm, cutoff):
+            BestTranscript.objects.refresh(asm, [cutoff])
+        connection = connections[self.db]
+        sql, params = locus_summary_sql(
+            (self.model, Transcript, BestTranscript, BlastHit), connection, asm.pk, cutoff)
+        with transaction.atomic(using=self.db):
+            connection.cursor().execute(sql, params)
+
+
 class Locus(models.Model):
     '''
     Locus. Transcripts grouped into one locus may or may not originate
     from the same genetic locus.
+    The summary columns (number of transcripts and BLAST hits, length
+    and coverage of the best transcript) are denormalized so loci can
+    be listed without a query per locus. They are filled in by the
+    import commands, see LocusManager.refresh_summaries.
     '''
     locus_id = models.PositiveIntegerField('Locus id', db_index=True)
     assembly = models.ForeignKey(Assembly)
+    num_transcripts = models.PositiveIntegerField('Transcripts', default=0)
+    max_length = models.PositiveIntegerField('Max transcript length', default=0)
+    best_length = models.PositiveIntegerField('Best transcript length', null=True, blank=True)
+    best_coverage = models.FloatField('Best transcript coverage', null=True, blank=True)
+    num_hits = models.PositiveIntegerField('BLAST hits', default=0)
+
+    objects = LocusManager()
     
     class Meta:
         unique_together = (('locus_id', 'assembly',),)
@@ -115,17 +237,59 @@ class RefSeq(models.Model):
 class TranscriptManager(models.Manager):
     
     def for_asm(self, asm):
-        return self.get_queryset().filter(locus__assembly=asm)
+        return self.get_queryset().filter(assembly=asm)
+
+    def set_assembly(self, asm):
+        '''
+        Sets the denormalized assembly of the transcripts in the loci of
+        the assembly, for transcripts imported before it was stored.
+        '''
+        return self.get_queryset().filter(locus__assembly=asm).exclude(
+            assembly=asm).update(assembly=asm)
+
+    def refresh_num_hits(self, asm):
+        '''
+        Recounts the BLAST hits of every transcript of the assembly in a
+        single UPDATE.
+        '''
+        connection = connections[self.db]
+        sql, params = transcript_hits_sql((self.model, BlastHit), connection, asm.pk)
+        with transaction.atomic(using=self.db):
+            connection.cursor().execute(sql, params)
         
-    def best_for_asm(self, asm):
+    def best_for_asm(self, asm, percent_cutoff=80):
         '''
         Returns a queryset containing the best transcript for every locus
-        for the given assembly.
+        for the given assembly (see best_for_locus). The selection is
+        done by the database in a single subquery, so the queryset stays
+        lazy and can be filtered and sliced as usual. Cutoffs stored in
+        BestTranscript are read from there.
         '''
-        pks = []
-        for loc in asm.locus_set.all():
-            pks.append(self.best_for_locus(loc).pk)
-        return self.get_queryset().filter(pk__in=pks)
+        qs = self.get_queryset()
+        if BestTranscript.objects.has_cutoff(asm, percent_cutoff):
+            return qs.filter(
+                besttranscript__assembly=asm, besttranscript__cutoff=percent_cutoff)
+        sql, params = best_transcripts_sql(self.model, connections[qs.db], asm.pk, percent_cutoff)
+        where = '{table}.{pk} IN (SELECT id FROM ({sql}) best)'.format(
+            table=connections[qs.db].ops.quote_name(self.model._meta.db_table),
+            pk=connections[qs.db].ops.quote_name(self.model._meta.pk.column),
+            sql=sql)
+        return qs.extra(where=[where], params=params)
+    
+    def with_preview(self, qs=None, length=SEQUENCE_PREVIEW):
+        '''
+        Defers the sequence of the transcripts in qs (all transcripts
+        by default) and selects its first length bases as
+        sequence_preview instead, so lists don't fetch whole sequences.
+        '''
+        if qs is None:
+            qs = self.get_queryset()
+        qn = connections[qs.db].ops.quote_name
+        preview = 'SUBSTR({table}.{sequence}, 1, %s)'.format(
+            table=qn(self.model._meta.db_table),
+            sequence=qn(self.model._meta.get_field('sequence').column))
+        return qs.defer('sequence').extra(
+            select={'sequence_preview': preview}, select_params=(length,))
     
     def for_locus(self, loc):
         '''
@@ -140,10 +304,15 @@ class TranscriptManager(models.Manager):
             return self.get_query_set().filter(locus__pk=int(loc))
             
     def best_for_locus(self, loc, percent_cutoff=80):
+        '''
+        The best transcript in the locus is the one with the highest
+        coverage among those longer than percent_cutoff % of the longest
+        transcript. Ties go to the transcript with the lowest pk.
+        '''
         qs = self.for_locus(loc)
         loc_data = qs.aggregate(Min('length'), Max('length'))
         return qs.filter(
-            length__gt=loc_data['length__max'] * percent_cutoff / 100).order_by('-coverage')[0]
+            length__gt=loc_data['length__max'] * percent_cutoff / 100).order_by('-coverage', 'pk')[0]
         
         #~ if qs.count() > 6:
             #~ loc_data = qs.aggregate(Min('length'), Max('length'))
@@ -165,12 +334,18 @@ class Transcript(models.Model):
         GGTTGCACCGCCGACCGACCCTGATCTTCTGTGAAGGGTTCGAGTTGGAGCACACCTGTC
         GGGACCCGAAAGATG
     '''
+    # Same as locus.assembly, stored so that transcripts of an assembly
+    # can be filtered without joining Locus
+    assembly = models.ForeignKey(Assembly, null=True, blank=True)
     locus = models.ForeignKey(Locus, null=True, blank=True)
     transcript_id = models.PositiveIntegerField('Transcript ID', db_index=True)
     confidence = models.FloatField('Confidence')
     length = models.PositiveIntegerField('Length')
     sequence = models.TextField('Sequence')
     coverage = models.FloatField('Coverage')
+    # Number of BlastHits, maintained by import_blast so that orphans
+    # can be found without joining BlastHit
+    num_hits = models.PositiveIntegerField('BLAST hits', default=0)
     
     blast_hits = models.ManyToManyField('RefSeq', through='BlastHit')
     
@@ -178,6 +353,11 @@ class Transcript(models.Model):
 
     class Meta:
         unique_together = (('locus', 'transcript_id',),)
+        index_together = (
+            ('assembly', 'coverage',),
+            ('assembly', 'length',),
+            ('locus', 'length', 'coverage',),
+            )
         ordering = ('locus', 'transcript_id',)
 
     def __unicode__(self):
@@ -191,6 +371,61 @@ class Transcript(models.Model):
     def get_absolute_url(self):
         return ('tasm_transcript_view', None, {'pk': self.pk,})
 
+    @property
+    def preview_truncated(self):
+        '''
+        True if sequence_preview (see TranscriptManager.with_preview)
+        is only the start of the sequence.
+        '''
+        return self.length > len(self.sequence_preview)
+
+
+class BestTranscriptManager(models.Manager):
+
+    def has_cutoff(self, asm, percent_cutoff):
+        return self.get_queryset().filter(assembly=asm, cutoff=percent_cutoff).exists()
+
+    def cutoffs_for(self, asm):
+        return sorted(self.get_queryset().filter(assembly=asm).values_list(
+            'cutoff', flat=True).distinct())
+
+    def refresh(self, asm, cutoffs=None):
+        '''
+        Recomputes the best transcripts of the assembly for the given
+        cutoffs (BEST_CUTOFFS by default), one INSERT ... SELECT per
+        cutoff.
+        '''
+        if cutoffs is None:
+            cutoffs = BEST_CUTOFFS
+        connection = connections[self.db]
+        with transaction.atomic(using=self.db):
+            self.get_queryset().filter(assembly=asm, cutoff__in=cutoffs).delete()
+            cursor = connection.cursor()
+            for cutoff in cutoffs:
+                sql, params = materialize_best_sql(self.model, Transcript, connection, asm.pk, cutoff)
+                cursor.execute(sql, params)
+
+
+class BestTranscript(models.Model):
+    '''
+    Best transcript of every locus (see TranscriptManager.best_for_locus)
+    for the length cutoffs in settings.TASM_BEST_CUTOFFS. Filled in by
+    setup_database and refreshed with the refresh_summaries command.
+    '''
+    assembly = models.ForeignKey(Assembly)
+    locus = models.ForeignKey(Locus)
+    transcript = models.ForeignKey(Transcript)
+    cutoff = models.PositiveSmallIntegerField('Length cutoff (%)')
+
+    objects = BestTranscriptManager()
+
+    class Meta:
+        unique_together = (('locus', 'cutoff',),)
+        index_together = (('assembly', 'cutoff',),)
+
+    def __unicode__(self):
+        return '{t} ({cutoff}%)'.format(t=self.transcript, cutoff=self.cutoff)
+
 
 class BlastHit(models.Model):
     '''
@@ -203,7 +438,10 @@ class BlastHit(models.Model):
     identities = models.PositiveIntegerField('Identical')
     expect = models.FloatField('Expect value')
     score = models.FloatField('Score')
-    
+
+    class Meta:
+        unique_together = (('transcript', 'refseq',),)
+
     def __unicode__(self):
         return '{asm}:{t} -- {seq}'.format(
             asm=self.transcript.assembly,
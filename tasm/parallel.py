@@ -0,0 +1,138 @@
+import mmap
+from collections import deque
+
+# Default size of the byte ranges handed out to worker processes. The
+# parsed records of a range are held in memory until they are written,
+# for up to workers + 1 ranges per input file.
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def fasta_boundary(data, pos):
+    '''
+    Returns the offset of the first FASTA record header ('>' at the
+    start of a line) after pos, or -1 if there is none.
+    '''
+    nxt = data.find(b'\n>', pos)
+    if nxt == -1:
+        return -1
+    return nxt + 1
+
+
+def xml_iteration_boundary(data, pos):
+    '''
+    Returns the offset of the first <Iteration> element of BLAST XML
+    output after pos, or -1 if there is none.
+    '''
+    return data.find(b'<Iteration>', pos)
+
+
+def xml_iteration_span(filename):
+    '''
+    Returns the (start, end) byte range of filename spanning all the
+    <Iteration> elements of BLAST XML output, or None if there are
+    none.
+    '''
+    with open(filename, 'rb') as fi:
+        fi.seek(0, 2)
+        if not fi.tell():
+            return None
+        mm = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            start = mm.find(b'<Iteration>')
+            end = mm.rfind(b'</Iteration>')
+            if start == -1 or end == -1:
+                return None
+            return start, end + len(b'</Iteration>')
+        finally:
+            mm.close()
+
+
+def tabular_boundary(data, pos, query_col=0):
+    '''
+    Returns the offset of the first line after pos that starts the
+    lines of a new query in tabular BLAST output, or -1 if there is
+    none. The lines of the query found at pos are skipped as they may
+    have started before pos. Comment lines (-outfmt 7) go with the
+    query that follows them.
+    '''
+    if pos and data[pos - 1:pos] != b'\n':
+        pos = data.find(b'\n', pos)
+        if pos == -1:
+            return -1
+        pos += 1
+    size = len(data)
+    query = None
+    block_end = pos
+    while pos < size:
+        eol = data.find(b'\n', pos)
+        if eol == -1:
+            eol = size
+        line = data[pos:eol]
+        if line.strip() and not line.startswith(b'#'):
+            q = line.split(b'\t', query_col + 1)[query_col]
+            if query is None:
+                query = q
+            elif q != query:
+                return block_end
+            block_end = eol + 1
+        pos = eol + 1
+    return -1
+
+
+def split_ranges(filename, boundary=fasta_boundary, chunk_size=CHUNK_SIZE, start=0, end=None):
+    '''
+    Splits the start:end part of filename into (start, end) byte ranges
+    of roughly chunk_size bytes. boundary(data, pos) must return the
+    offset of the first record boundary at or after pos (or -1), so
+    that every range starts at a record and no record is split across
+    two ranges.
+    '''
+    with open(filename, 'rb') as fi:
+        fi.seek(0, 2)
+        size = fi.tell()
+        if end is None:
+            end = size
+        if not size or start >= end:
+            return []
+        mm = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            ranges = []
+            pos = start
+            while pos < end:
+                nxt = end
+                if pos + chunk_size < end:
+                    nxt = boundary(mm, pos + chunk_size)
+                    if nxt == -1 or nxt > end:
+                        nxt = end
+                ranges.append((pos, nxt))
+                pos = nxt
+            return ranges
+        finally:
+            mm.close()
+
+
+def imap_ordered(pool, func, items, window):
+    '''
+    Like pool.imap but never has more than window tasks in flight, so
+    results waiting to be consumed don't pile up in memory. Results
+    are yielded in the order of items.
+    '''
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+class NullLock(object):
+    '''
+    Stand-in for a lock or semaphore when nothing needs to be
+    throttled.
+    '''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
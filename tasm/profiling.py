@@ -0,0 +1,131 @@
+from __future__ import division
+import json
+import resource
+import time
+from contextlib import contextmanager
+
+from django.db import connection, reset_queries as django_reset_queries
+
+
+def _cpu_time(who=resource.RUSAGE_SELF):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _peak_rss():
+    '''
+    Peak resident set size of this process in MB (ru_maxrss is in KB
+    on Linux).
+    '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class PhaseStats(object):
+    '''
+    Wall time, CPU time, rows, DB queries and peak RSS of an import
+    phase. Entering the same phase repeatedly accumulates the values.
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.rows = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.queries = 0
+        self.peak_rss = 0.0
+
+    @property
+    def rate(self):
+        if self.wall:
+            return self.rows / self.wall
+        return 0.0
+
+    def as_dict(self):
+        return dict(
+            phase=self.name,
+            rows=self.rows,
+            wall=self.wall,
+            cpu=self.cpu,
+            rows_per_sec=self.rate,
+            queries=self.queries,
+            peak_rss_mb=self.peak_rss
+            )
+
+
+class Profiler(object):
+    '''
+    Collects PhaseStats for the phases of an import command. When not
+    enabled phase() costs next to nothing and nothing is reported.
+
+    Query counts need the debug cursor, which logs every query in
+    connection.queries, so the import commands call reset_queries()
+    of the profiler instead of Django's to keep memory flat without
+    losing the count.
+    '''
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.phases = []
+        self._by_name = {}
+        self._queries = 0
+        self._null = PhaseStats(None)
+        self.started = time.time()
+        if enabled:
+            connection.use_debug_cursor = True
+
+    def query_count(self):
+        return self._queries + len(connection.queries)
+
+    def reset_queries(self):
+        self._queries += len(connection.queries)
+        django_reset_queries()
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield self._null
+            return
+        if name not in self._by_name:
+            self._by_name[name] = PhaseStats(name)
+            self.phases.append(self._by_name[name])
+        stats = self._by_name[name]
+        wall, cpu, queries = time.time(), _cpu_time(), self.query_count()
+        try:
+            yield stats
+        finally:
+            stats.wall += time.time() - wall
+            stats.cpu += _cpu_time() - cpu
+            stats.queries += self.query_count() - queries
+            stats.peak_rss = max(stats.peak_rss, _peak_rss())
+
+    def report(self, stdout):
+        if not self.enabled:
+            return
+        line = '{0:<24} {1:>10} {2:>9} {3:>9} {4:>10} {5:>8} {6:>9}'
+        stdout.write(line.format(
+            'Phase', 'Rows', 'Wall (s)', 'CPU (s)', 'Rows/sec', 'Queries', 'RSS (MB)'))
+        for stats in self.phases:
+            stdout.write(line.format(
+                stats.name,
+                stats.rows,
+                '%.2f' % stats.wall,
+                '%.2f' % stats.cpu,
+                '%.0f' % stats.rate,
+                stats.queries,
+                '%.1f' % stats.peak_rss
+                ))
+        stdout.write('Worker processes CPU (s): %.2f' % _cpu_time(resource.RUSAGE_CHILDREN))
+
+    def dump_json(self, filename, **extra):
+        '''
+        Writes a machine readable summary of the phases to filename.
+        extra is added to the top level object (command, assembly...).
+        '''
+        summary = dict(extra)
+        summary.update(
+            started=self.started,
+            wall=time.time() - self.started,
+            children_cpu=_cpu_time(resource.RUSAGE_CHILDREN),
+            peak_rss_mb=_peak_rss(),
+            phases=[stats.as_dict() for stats in self.phases]
+            )
+        with open(filename, 'w') as fo:
+            json.dump(summary, fo, indent=2)
@@ -0,0 +1,42 @@
+from __future__ import division
+import time
+
+
+class PhaseProgress(object):
+    '''
+    Keeps track of the number of rows processed during a single import
+    phase and reports throughput as the phase goes.
+    '''
+    def __init__(self, name, stdout):
+        self.name = name
+        self.stdout = stdout
+        self.rows = 0
+        self.start = time.time()
+
+    @property
+    def elapsed(self):
+        return time.time() - self.start
+
+    @property
+    def rate(self):
+        elapsed = self.elapsed
+        if elapsed:
+            return self.rows / elapsed
+        return 0.0
+
+    def update(self, rows):
+        self.rows += rows
+        self.stdout.write('...\t{name}: {rows} rows ({rate:.0f} rows/sec) ...'.format(
+            name=self.name,
+            rows=self.rows,
+            rate=self.rate
+            ))
+
+    def finish(self):
+        self.stdout.write('...\t{name}: {rows} rows in {elapsed:.1f} sec ({rate:.0f} rows/sec)'.format(
+            name=self.name,
+            rows=self.rows,
+            elapsed=self.elapsed,
+            rate=self.rate
+            ))
+        return self.rows
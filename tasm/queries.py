@@ -0,0 +1,198 @@
+'''
+Raw SQL for queries the ORM can't express in a single statement.
+'''
+
+# Best transcript per locus of an assembly: among the transcripts longer
+# than percent_cutoff % of the longest one in the locus, the one with
+# the highest coverage (ties go to the lowest pk). The length condition
+# is written as length * 100 > max_length * percent_cutoff to avoid
+# integer division differences between backends.
+
+BEST_WINDOW_SQL = '''
+SELECT ranked.id FROM (
+    SELECT eligible.id, ROW_NUMBER() OVER (
+        PARTITION BY eligible.locus_id
+        ORDER BY eligible.coverage DESC, eligible.id) AS rn
+    FROM (
+        SELECT t.{id} AS id, t.{locus} AS locus_id, t.{coverage} AS coverage,
+            t.{length} AS length, MAX(t.{length}) OVER (PARTITION BY t.{locus}) AS max_length
+        FROM {transcript} t
+        WHERE t.{assembly} = %s
+    ) eligible
+    WHERE eligible.length * 100 > eligible.max_length * %s
+) ranked
+WHERE ranked.rn = 1
+'''
+
+BEST_GROUPED_SQL = '''
+SELECT MIN(t.{id}) AS id FROM {transcript} t
+JOIN (
+    SELECT t.{locus} AS locus_id, MAX(t.{length}) AS max_length
+    FROM {transcript} t
+    WHERE t.{assembly} = %s
+    GROUP BY t.{locus}
+) m ON m.locus_id = t.{locus}
+JOIN (
+    SELECT t.{locus} AS locus_id, MAX(t.{coverage}) AS coverage
+    FROM {transcript} t
+    JOIN (
+        SELECT t.{locus} AS locus_id, MAX(t.{length}) AS max_length
+        FROM {transcript} t
+        WHERE t.{assembly} = %s
+        GROUP BY t.{locus}
+    ) m ON m.locus_id = t.{locus}
+    WHERE t.{length} * 100 > m.max_length * %s
+    GROUP BY t.{locus}
+) b ON b.locus_id = t.{locus} AND b.coverage = t.{coverage}
+WHERE t.{length} * 100 > m.max_length * %s
+GROUP BY t.{locus}
+'''
+
+
+def supports_window_functions(connection):
+    '''
+    True if the database behind connection has ROW_NUMBER() OVER (...):
+    PostgreSQL, SQLite 3.25+ and MySQL 8.0+. MariaDB reports its own
+    version (10.x) and has them since 10.2.
+    '''
+    if connection.vendor == 'postgresql':
+        return True
+    if connection.vendor == 'sqlite':
+        return connection.Database.sqlite_version_info >= (3, 25, 0)
+    if connection.vendor == 'mysql':
+        return connection.mysql_version >= (8, 0, 2)
+    return False
+
+
+def best_transcripts_sql(model, connection, asm_pk, percent_cutoff=80):
+    '''
+    Returns (sql, params) for a query selecting the pks of the best
+    transcript of every locus of the assembly with asm_pk. model is
+    Transcript. Uses window functions if the database has them and a
+    grouped join otherwise.
+    '''
+    qn = connection.ops.quote_name
+    column = lambda name: qn(model._meta.get_field(name).column)
+    names = dict(
+        transcript=qn(model._meta.db_table),
+        id=qn(model._meta.pk.column),
+        locus=column('locus'),
+        length=column('length'),
+        coverage=column('coverage'),
+        assembly=column('assembly'),
+        )
+    if supports_window_functions(connection):
+        return BEST_WINDOW_SQL.format(**names), [asm_pk, percent_cutoff]
+    return BEST_GROUPED_SQL.format(**names), [asm_pk, asm_pk, percent_cutoff, percent_cutoff]
+
+
+def materialize_best_sql(best_model, model, connection, asm_pk, percent_cutoff):
+    '''
+    Returns (sql, params) for an INSERT ... SELECT storing the best
+    transcripts of the assembly for percent_cutoff in the best_model
+    (BestTranscript) table.
+    '''
+    qn = connection.ops.quote_name
+    opts = best_model._meta
+    select, params = best_transcripts_sql(model, connection, asm_pk, percent_cutoff)
+    sql = (
+        'INSERT INTO {best} ({assembly}, {locus}, {transcript}, {cutoff}) '
+        'SELECT %s, t.{t_locus}, t.{t_id}, %s FROM {t_table} t '
+        'WHERE t.{t_id} IN (SELECT id FROM ({select}) best)'
+        ).format(
+            best=qn(opts.db_table),
+            assembly=qn(opts.get_field('assembly').column),
+            locus=qn(opts.get_field('locus').column),
+            transcript=qn(opts.get_field('transcript').column),
+            cutoff=qn(opts.get_field('cutoff').column),
+            t_locus=qn(model._meta.get_field('locus').column),
+            t_id=qn(model._meta.pk.column),
+            t_table=qn(model._meta.db_table),
+            select=select)
+    return sql, [asm_pk, percent_cutoff] + params
+
+
+LOCUS_SUMMARY_SQL = '''
+UPDATE {locus_table} SET
+    {num_transcripts} = (
+        SELECT COUNT(*) FROM {transcript} t
+        WHERE t.{t_locus} = {locus_table}.{locus_pk}),
+    {max_length} = (
+        SELECT COALESCE(MAX(t.{t_length}), 0) FROM {transcript} t
+        WHERE t.{t_locus} = {locus_table}.{locus_pk}),
+    {best_length} = (
+        SELECT t.{t_length} FROM {best} b
+        JOIN {transcript} t ON t.{t_id} = b.{b_transcript}
+        WHERE b.{b_locus} = {locus_table}.{locus_pk} AND b.{b_cutoff} = %s),
+    {best_coverage} = (
+        SELECT t.{t_coverage} FROM {best} b
+        JOIN {transcript} t ON t.{t_id} = b.{b_transcript}
+        WHERE b.{b_locus} = {locus_table}.{locus_pk} AND b.{b_cutoff} = %s),
+    {num_hits} = (
+        SELECT COUNT(*) FROM {hit} h
+        JOIN {transcript} t ON t.{t_id} = h.{h_transcript}
+        WHERE t.{t_locus} = {locus_table}.{locus_pk})
+WHERE {locus_table}.{assembly} = %s
+'''
+
+
+def locus_summary_sql(models, connection, asm_pk, percent_cutoff):
+    '''
+    Returns (sql, params) for an UPDATE recomputing the summary columns
+    of all loci of the assembly with correlated subqueries. models is
+    a (Locus, Transcript, BestTranscript, BlastHit) tuple. The best
+    transcript is read from BestTranscript for percent_cutoff.
+    '''
+    qn = connection.ops.quote_name
+    column = lambda model, name: qn(model._meta.get_field(name).column)
+    locus_model, transcript_model, best_model, hit_model = models
+    sql = LOCUS_SUMMARY_SQL.format(
+        locus_table=qn(locus_model._meta.db_table),
+        locus_pk=qn(locus_model._meta.pk.column),
+        assembly=column(locus_model, 'assembly'),
+        num_transcripts=column(locus_model, 'num_transcripts'),
+        max_length=column(locus_model, 'max_length'),
+        best_length=column(locus_model, 'best_length'),
+        best_coverage=column(locus_model, 'best_coverage'),
+        num_hits=column(locus_model, 'num_hits'),
+        transcript=qn(transcript_model._meta.db_table),
+        t_id=qn(transcript_model._meta.pk.column),
+        t_locus=column(transcript_model, 'locus'),
+        t_length=column(transcript_model, 'length'),
+        t_coverage=column(transcript_model, 'coverage'),
+        best=qn(best_model._meta.db_table),
+        b_transcript=column(best_model, 'transcript'),
+        b_locus=column(best_model, 'locus'),
+        b_cutoff=column(best_model, 'cutoff'),
+        hit=qn(hit_model._meta.db_table),
+        h_transcript=column(hit_model, 'transcript'),
+        )
+    return sql, [percent_cutoff, percent_cutoff, asm_pk]
+
+
+TRANSCRIPT_HITS_SQL = '''
+UPDATE {transcript} SET {num_hits} = (
+    SELECT COUNT(*) FROM {hit} h
+    WHERE h.{h_transcript} = {transcript}.{t_id})
+WHERE {transcript}.{assembly} = %s
+'''
+
+
+def transcript_hits_sql(models, connection, asm_pk):
+    '''
+    Returns (sql, params) for an UPDATE recomputing the number of BLAST
+    hits of all transcripts of the assembly. models is a (Transcript,
+    BlastHit) tuple.
+    '''
+    qn = connection.ops.quote_name
+    column = lambda model, name: qn(model._meta.get_field(name).column)
+    transcript_model, hit_model = models
+    sql = TRANSCRIPT_HITS_SQL.format(
+        transcript=qn(transcript_model._meta.db_table),
+        t_id=qn(transcript_model._meta.pk.column),
+        num_hits=column(transcript_model, 'num_hits'),
+        assembly=column(transcript_model, 'assembly'),
+        hit=qn(hit_model._meta.db_table),
+        h_transcript=column(hit_model, 'transcript'),
+        )
+    return sql, [asm_pk]
@@ -0,0 +1,242 @@
+import bz2
+import gzip
+import mmap
+import os
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# Size of the blocks read from disk by the buffered FASTA reader
+BUFFER_SIZE = 4 * 1024 * 1024
+
+# Suffixes tried, in order, when looking for a (compressed) input file
+INPUT_SUFFIXES = ('', '.gz', '.bgz', '.bz2', '.xz')
+
+# Magic bytes of the supported compression formats. bgzip files are
+# gzip files made of many members and are read by the gzip module.
+MAGIC = (
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    )
+
+
+def compression(filename):
+    '''
+    Returns the compression format of filename ('gzip', 'bz2' or 'xz')
+    based on its first bytes, or None for uncompressed files.
+    '''
+    with open(filename, 'rb') as fi:
+        head = fi.read(6)
+    for magic, fmt in MAGIC:
+        if head.startswith(magic):
+            return fmt
+    return None
+
+
+def find_input(directory, name):
+    '''
+    Returns the path to name in directory, or to a compressed version
+    of it (name.gz, name.bz2, ...), or None if there is neither.
+    '''
+    for suffix in INPUT_SUFFIXES:
+        path = os.path.join(directory, name + suffix)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def open_input(filename, use_mmap=False):
+    '''
+    Opens filename for binary reading. gzip/bgzip, bz2 and xz files are
+    decompressed on the fly. Uncompressed files are memory mapped if
+    use_mmap is set. Returns a file-like object with read() and
+    readline(); use contextlib.closing to close it.
+    '''
+    fmt = compression(filename)
+    if fmt == 'gzip':
+        return gzip.GzipFile(filename, 'rb')
+    if fmt == 'bz2':
+        return bz2.BZ2File(filename, 'rb')
+    if fmt == 'xz':
+        if lzma is None:
+            raise IOError('lzma module is required to read {0}'.format(filename))
+        return lzma.LZMAFile(filename, 'rb')
+    if use_mmap and os.path.getsize(filename):
+        with open(filename, 'rb') as fi:
+            return mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+    return open(filename, 'rb')
+
+
+class RangeReader(object):
+    '''
+    Read-only file-like view of the start:end byte range of filename,
+    optionally surrounded by prefix and suffix, e.g. to turn a slice of
+    a large XML document into a well formed one. Supports read() and
+    readline().
+    '''
+    def __init__(self, filename, start, end, prefix=b'', suffix=b'', bufsize=64 * 1024):
+        self._fi = open(filename, 'rb')
+        self._fi.seek(start)
+        self._blocks = self._iter_blocks(end - start, prefix, suffix, bufsize)
+        # Data is consumed by moving _pos, the buffer is only copied
+        # when the next block is appended to what is left of it
+        self._buf = b''
+        self._pos = 0
+
+    def _iter_blocks(self, left, prefix, suffix, bufsize):
+        yield prefix
+        while left > 0:
+            data = self._fi.read(min(bufsize, left))
+            if not data:
+                break
+            left -= len(data)
+            yield data
+        yield suffix
+
+    def _more(self):
+        block = next(self._blocks, None)
+        if block is None:
+            return False
+        self._buf = self._buf[self._pos:] + block
+        self._pos = 0
+        return True
+
+    def read(self, size=-1):
+        if size < 0:
+            while self._more():
+                pass
+            size = len(self._buf) - self._pos
+        else:
+            while len(self._buf) - self._pos < size and self._more():
+                pass
+        data = self._buf[self._pos:self._pos + size]
+        self._pos += len(data)
+        return data
+
+    def readline(self):
+        eol = self._buf.find(b'\n', self._pos)
+        while eol == -1:
+            searched = len(self._buf) - self._pos
+            if not self._more():
+                break
+            eol = self._buf.find(b'\n', searched)
+        end = eol + 1 if eol != -1 else len(self._buf)
+        line = self._buf[self._pos:end]
+        self._pos = end
+        return line
+
+    def close(self):
+        self._fi.close()
+
+
+def _parse_record(data, start, stop):
+    '''
+    Splits a single FASTA record found in data[start:stop] into the
+    header (without the leading '>') and the sequence with line breaks
+    removed.
+    '''
+    record = data[start:stop]
+    eol = record.find(b'\n')
+    if eol == -1:
+        return record[1:].rstrip(), b''
+    header = record[1:eol].rstrip()
+    seq = record[eol + 1:].replace(b'\n', b'')
+    if b'\r' in seq:
+        seq = seq.replace(b'\r', b'')
+    return header, seq
+
+
+def _first_record(data, pos, stop=None):
+    '''
+    Returns the offset of the first record header at or after pos,
+    skipping anything (blank lines etc.) in front of it.
+    '''
+    if stop is None:
+        stop = len(data)
+    if data[pos:pos + 1] == b'>':
+        return pos
+    nxt = data.find(b'\n>', pos, stop)
+    if nxt == -1:
+        return stop
+    return nxt + 1
+
+
+def _iter_buffered(handle, bufsize):
+    pending = b''
+    first = True
+    while True:
+        chunk = handle.read(bufsize)
+        if not chunk:
+            break
+        data = pending + chunk
+        pos = 0
+        if first:
+            pos = _first_record(data, 0)
+            first = pos == len(data)
+        # Continue the search where the previous block left off
+        search = max(pos, len(pending) - 1)
+        while True:
+            nxt = data.find(b'\n>', search)
+            if nxt == -1:
+                break
+            yield _parse_record(data, pos, nxt)
+            pos = search = nxt + 1
+        pending = data[pos:]
+    if pending.strip():
+        yield _parse_record(pending, 0, len(pending))
+
+
+def _iter_mmap(filename, start, end):
+    with open(filename, 'rb') as fi:
+        fi.seek(0, 2)
+        if not fi.tell():
+            return
+        mm = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if end is None or end > len(mm):
+                end = len(mm)
+            pos = _first_record(mm, start, end)
+            while pos < end:
+                nxt = mm.find(b'\n>', pos, end)
+                if nxt == -1:
+                    nxt = end
+                yield _parse_record(mm, pos, nxt)
+                pos = nxt + 1
+        finally:
+            mm.close()
+
+
+def read_fasta(filename, use_mmap=False, start=0, end=None, bufsize=BUFFER_SIZE):
+    '''
+    Lightweight FASTA reader. Yields (header, sequence) tuples of byte
+    strings for every record in filename; the header comes without
+    the leading '>' and can be passed on to tasm.utils.parse_header.
+
+    The file is read in large blocks and split on record boundaries
+    without building any intermediate objects. With use_mmap the file
+    is memory mapped instead, which also allows reading only the
+    records that start within the start:end byte range. Compressed
+    files are decompressed on the fly and always read in blocks.
+    '''
+    if compression(filename):
+        if start or end is not None:
+            raise ValueError('Byte ranges are not supported for compressed files.')
+        return _read_buffered(filename, bufsize)
+    if use_mmap or start or end is not None:
+        return _iter_mmap(filename, start, end)
+    return _read_buffered(filename, bufsize)
+
+
+def _read_buffered(filename, bufsize):
+    fi = open_input(filename)
+    try:
+        for rec in _iter_buffered(fi, bufsize):
+            yield rec
+    finally:
+        fi.close()
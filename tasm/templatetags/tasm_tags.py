@@ -59,10 +59,14 @@ pretty_seq.is_safe = True
 
 @register.filter(is_safe=True)
 def best_length(locus):
+    if locus.best_length is not None:
+        return locus.best_length
     return Transcript.objects.best_for_locus(locus).length
 
 @register.filter(is_safe=True)
 def best_coverage(locus):
+    if locus.best_coverage is not None:
+        return locus.best_coverage
     return Transcript.objects.best_for_locus(locus).coverage
 
 @register.simple_tag
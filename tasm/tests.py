@@ -1,16 +1,884 @@
-"""
-This file demonstrates writing tests using the unittest module. These will pass
-when you run "manage.py test".
+import gzip
+import math
+import os
+import random
+import shutil
+import tempfile
+from StringIO import StringIO
+from xml.sax.saxutils import escape
 
-Replace this with more appropriate tests for your application.
-"""
+from scipy.stats import gmean
 
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.http import Http404
 from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
 
+from tasm.blast import (parse_blast_xml, parse_blast_tabular, seqid_accession,
+    check_tabular_fields, Hit, TABULAR_FIELDS)
+from tasm.cache import CACHE_ALIAS, generations, invalidate, list_cache_key, get_list_cache
+from tasm.bulkload import indexes_disabled, model_indexes, restore_indexes, _table_indexes
+from tasm.keyset import KeysetPaginator, orderable, encode_cursor
+from tasm.management.commands.import_blast import _xml_worker, _tabular_worker
+from tasm import queries
+from tasm.models import (Assembly, Locus, Transcript, BestTranscript, RefSeq, BlastHit,
+    Contig, Stat, ImportPhase, AssemblyStats)
+from tasm.parallel import (split_ranges, xml_iteration_boundary, xml_iteration_span,
+    tabular_boundary)
+from tasm.readers import read_fasta, RangeReader
+from tasm.utils import build_coverage_index, transcript_coverage
+from tasm.views import FilteredListView, HomeView
 
-class SimpleTest(TestCase):
-    def test_basic_addition(self):
-        """
-        Tests that 1 + 1 always equals 2.
-        """
-        self.assertEqual(1 + 1, 2)
+STATS = '''ID\tlgth\tout\tin\tlong_cov
+1\t100\t1\t0\t10.0
+2\t80\t1\t1\t2.5
+3\t50\t0\t1\t0.0
+4\t40\t0\t0\tInf
+6\t120\t1\t1\t7.25
+'''
+
+
+class TranscriptCoverageTest(TestCase):
+    '''
+    transcript_coverage has to give the scipy.stats.gmean of the
+    coverage of the distinct nodes of a transcript that have one.
+    '''
+    def setUp(self):
+        self.covs = {1: 10.0, 2: 2.5, 3: 0.0, 6: 7.25}
+        self.index = build_coverage_index(StringIO(STATS))
+
+    def expected(self, ids):
+        values = [self.covs[i] for i in sorted(set(ids)) if i in self.covs]
+        if not values:
+            return float('nan')
+        return gmean(values)
+
+    def assertCoverage(self, contig_ids):
+        result = transcript_coverage(self.index, contig_ids)
+        self.assertEqual(len(result), len(contig_ids))
+        for ids, value in zip(contig_ids, result):
+            expected = self.expected(ids)
+            if math.isnan(expected):
+                self.assertTrue(math.isnan(value), (ids, value))
+            else:
+                self.assertAlmostEqual(value, expected, places=12, msg=ids)
+
+    def test_index(self):
+        self.assertEqual(len(self.index), 7)
+        self.assertEqual(self.index[6], 7.25)
+        # Inf and missing ids
+        self.assertTrue(math.isnan(self.index[4]))
+        self.assertTrue(math.isnan(self.index[5]))
+
+    def test_gmean(self):
+        self.assertCoverage([[1, 2], [6], [1, 2, 6]])
+
+    def test_repeated_nodes(self):
+        self.assertCoverage([[1, 1, 2], [6, 2, 6, 6]])
+
+    def test_missing_nodes(self):
+        # Inf coverage, missing from stats.txt and beyond the index
+        self.assertCoverage([[1, 4], [2, 5], [6, 1000]])
+
+    def test_zero_coverage(self):
+        self.assertCoverage([[3], [1, 3]])
+        self.assertEqual(transcript_coverage(self.index, [[1, 3]])[0], 0.0)
+
+    def test_no_covered_nodes(self):
+        self.assertCoverage([[4, 5], [1], [], [1000]])
+        self.assertTrue(math.isnan(transcript_coverage(self.index, [[]])[0]))
+
+
+class TempDirMixin(object):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_file(self, name, data, compress=False):
+        path = os.path.join(self.tmpdir, name)
+        opener = gzip.open if compress else open
+        with opener(path, 'wb') as fo:
+            fo.write(data)
+        return path
+
+
+def make_fasta(n=200, seed=0):
+    '''
+    Returns (records, data) for n random FASTA records with sequences
+    wrapped at 60 bases, some of them empty or unwrapped.
+    '''
+    rnd = random.Random(seed)
+    records = []
+    lines = []
+    for i in range(n):
+        header = 'Locus_{0}_Transcript_1/1_Confidence_1.000_Length_{1}'.format(i + 1, i)
+        seq = ''.join(rnd.choice('ACGT') for j in range(rnd.randint(0, 400)))
+        records.append((header, seq))
+        lines.append('>' + header)
+        width = 60 if i % 3 else 1000
+        lines.extend(seq[j:j + width] for j in range(0, len(seq), width))
+    return records, '\n'.join(lines) + '\n'
+
+
+class ReadFastaTest(TempDirMixin, TestCase):
+
+    def setUp(self):
+        super(ReadFastaTest, self).setUp()
+        self.records, data = make_fasta()
+        self.path = self.write_file('transcripts.fa', data)
+        self.gz_path = self.write_file('transcripts.fa.gz', data, compress=True)
+
+    def test_read(self):
+        self.assertEqual(list(read_fasta(self.path)), self.records)
+        self.assertEqual(list(read_fasta(self.path, use_mmap=True)), self.records)
+        self.assertEqual(list(read_fasta(self.gz_path)), self.records)
+
+    def test_small_buffer(self):
+        # Records spanning many buffer refills
+        self.assertEqual(list(read_fasta(self.path, bufsize=17)), self.records)
+
+    def test_split_ranges(self):
+        size = os.path.getsize(self.path)
+        for chunk_size in (1, 100, 4096, size, 2 * size):
+            ranges = split_ranges(self.path, chunk_size=chunk_size)
+            self.assertEqual(ranges[0][0], 0)
+            self.assertEqual(ranges[-1][1], size)
+            for (s1, e1), (s2, e2) in zip(ranges, ranges[1:]):
+                self.assertEqual(e1, s2)
+            records = []
+            for start, end in ranges:
+                records.extend(read_fasta(self.path, start=start, end=end))
+            self.assertEqual(records, self.records, chunk_size)
+
+    def test_empty_file(self):
+        path = self.write_file('empty.fa', '')
+        self.assertEqual(split_ranges(path), [])
+        self.assertEqual(list(read_fasta(path)), [])
+
+
+class IndexesTest(TestCase):
+    '''
+    Indexes dropped by indexes_disabled must come back from the model
+    definition, also when the load never got to rebuild them.
+    '''
+    def setUp(self):
+        self.table = Transcript._meta.db_table
+        self.names = set(name for name, sql in model_indexes(Transcript))
+
+    def existing(self):
+        return _table_indexes(connection, self.table)
+
+    def test_model_indexes(self):
+        self.assertEqual(len(self.names), 6)
+        self.assertTrue(self.names <= self.existing())
+
+    def test_indexes_disabled(self):
+        with indexes_disabled(Transcript):
+            self.assertFalse(self.names & self.existing())
+        self.assertTrue(self.names <= self.existing())
+
+    def test_restore_indexes(self):
+        cursor = connection.cursor()
+        dropped = sorted(self.names)[:2]
+        for name in dropped:
+            cursor.execute('DROP INDEX {0}'.format(connection.ops.quote_name(name)))
+        self.assertEqual(sorted(restore_indexes(Transcript)), dropped)
+        self.assertTrue(self.names <= self.existing())
+        self.assertEqual(restore_indexes(Transcript), [])
+
+
+TABULAR = '''Locus_1_Transcript_1/1\tNM_000077.1\tGene A, mRNA\t1077\t383\t380\t1e-06\t766
+Locus_1_Transcript_1/1\tNM_000077.1\tGene A, mRNA\t1077\t50\t50\t1e-03\t100
+Locus_1_Transcript_1/1\tXM_000048.3\tGene B, mRNA\t1048\t69\t66\t1e-05\t138
+Locus_2_Transcript_1/1\tNR_000187.2\tGene C, ncRNA\t1187\t100\t99\t0.0\t200
+'''
+
+
+class BlastTabularTest(TestCase):
+
+    def test_accession(self):
+        for seqid in ('NM_000077.1', 'NM_000077', 'gi|1077|ref|NM_000077.1|',
+                'ref|NM_000077.1|'):
+            self.assertEqual(seqid_accession(seqid), 'NM_000077', seqid)
+        self.assertEqual(seqid_accession('lcl|contig.1'), 'contig.1')
+
+    def test_required_fields(self):
+        check_tabular_fields(TABULAR_FIELDS)
+        default = ('qseqid sseqid pident length mismatch gapopen qstart qend '
+            'sstart send evalue bitscore').split()
+        self.assertRaises(ValueError, check_tabular_fields, default)
+        for name in ('stitle', 'slen', 'score'):
+            fields = [f for f in TABULAR_FIELDS if f != name]
+            self.assertRaises(ValueError, check_tabular_fields, fields)
+
+    def test_parse(self):
+        fields = ['saccver' if f == 'sacc' else f for f in TABULAR_FIELDS]
+        records = list(parse_blast_tabular(StringIO(TABULAR), fields=fields))
+        self.assertEqual([(q, len(hits)) for q, hits in records],
+            [('Locus_1_Transcript_1/1', 2), ('Locus_2_Transcript_1/1', 1)])
+        hit = records[0][1][0]
+        self.assertEqual((hit.accession, hit.definition, hit.length, hit.score),
+            ('NM_000077', 'Gene A, mRNA', 1077, 766))
+        self.assertEqual([h.accession for q, hits in records for h in hits],
+            ['NM_000077', 'XM_000048', 'NR_000187'])
+
+    def test_wrong_columns(self):
+        self.assertRaises(ValueError, list,
+            parse_blast_tabular(StringIO(TABULAR), fields=TABULAR_FIELDS + ('bitscore',)))
+
+
+XML_HEAD = '''<?xml version="1.0"?>
+<!DOCTYPE BlastOutput PUBLIC "-//NCBI//NCBI BlastOutput/EN" "http://www.ncbi.nlm.nih.gov/dtd/NCBI_BlastOutput.dtd">
+<BlastOutput>
+  <BlastOutput_program>blastn</BlastOutput_program>
+  <BlastOutput_db>refseq_rna</BlastOutput_db>
+  <BlastOutput_query-def>{query}</BlastOutput_query-def>
+  <BlastOutput_iterations>
+'''
+
+XML_ITERATION = '''<Iteration>
+  <Iteration_iter-num>{num}</Iteration_iter-num>
+  <Iteration_query-def>{query}</Iteration_query-def>
+  <Iteration_hits>
+{hits}  </Iteration_hits>
+</Iteration>
+'''
+
+XML_HIT = '''<Hit>
+  <Hit_id>gi|{gi}|ref|{accession}.1|</Hit_id>
+  <Hit_def>{definition}</Hit_def>
+  <Hit_accession>{accession}</Hit_accession>
+  <Hit_len>{length}</Hit_len>
+  <Hit_hsps>
+    <Hsp>
+      <Hsp_score>{score}</Hsp_score>
+      <Hsp_evalue>{expect!r}</Hsp_evalue>
+      <Hsp_identity>{identities}</Hsp_identity>
+      <Hsp_align-len>{align_length}</Hsp_align-len>
+    </Hsp>
+  </Hit_hsps>
+</Hit>
+'''
+
+XML_TAIL = '''  </BlastOutput_iterations>
+</BlastOutput>
+'''
+
+
+def make_blast_records(n=100, seed=0):
+    '''
+    Returns n random (query, hits) BLAST records, some of them without
+    hits, as yielded by parse_blast_xml without any cutoffs.
+    '''
+    rnd = random.Random(seed)
+    records = []
+    for i in range(n):
+        query = 'Locus_{0}_Transcript_1/1_Confidence_1.000_Length_{1}'.format(
+            i + 1, rnd.randint(100, 5000))
+        hits = []
+        # BLAST reports every subject once per query
+        for num in rnd.sample(range(1, 1000), rnd.choice((0, 1, 3, 5))):
+            align_length = rnd.randint(20, 1000)
+            hits.append(Hit(
+                accession='NM_{0:06d}'.format(num),
+                definition='Gene {0} & friends, mRNA'.format(num),
+                length=rnd.randint(align_length, 5000),
+                align_length=align_length,
+                identities=rnd.randint(align_length // 2, align_length),
+                expect=rnd.choice((0.0, 1e-50, 1e-10, 1e-4, 0.01, 2.5)),
+                score=float(rnd.randint(40, 2000))))
+        records.append((query, hits))
+    return records
+
+
+def blast_xml(records):
+    iterations = []
+    for num, (query, hits) in enumerate(records):
+        xml_hits = ''.join(
+            XML_HIT.format(gi=1000 + i, **hit._replace(definition=escape(hit.definition))._asdict())
+            for i, hit in enumerate(hits))
+        iterations.append(XML_ITERATION.format(num=num + 1, query=query, hits=xml_hits))
+    query = records[0][0] if records else ''
+    return XML_HEAD.format(query=query) + ''.join(iterations) + XML_TAIL
+
+
+class BlastXmlTest(TestCase):
+
+    def setUp(self):
+        self.records = make_blast_records()
+        self.xml = blast_xml(self.records)
+
+    def parse(self, **kwargs):
+        return list(parse_blast_xml(StringIO(self.xml), **kwargs))
+
+    def test_parse(self):
+        self.assertEqual(self.parse(), self.records)
+
+    def test_cutoffs(self):
+        expected = [(query, [h for h in hits if h.expect <= 1e-4][:2])
+            for query, hits in self.records]
+        self.assertEqual(self.parse(expect=1e-4, max_hits=2), expected)
+
+    def test_default_query(self):
+        # Pre 2.2.14 BLAST has the query only in the header
+        self.xml = self.xml.replace('<Iteration_query-def>', '<Iteration_query-ID>').replace(
+            '</Iteration_query-def>', '</Iteration_query-ID>')
+        query = self.records[0][0]
+        self.assertEqual(self.parse(), [(query, hits) for q, hits in self.records])
+
+    def test_empty(self):
+        self.assertEqual(list(parse_blast_xml(StringIO(blast_xml([])))), [])
+
+
+def blast_tabular(records, comments=False):
+    lines = []
+    for query, hits in records:
+        if comments:
+            lines.append('# BLASTN 2.2.28+')
+            lines.append('# Query: {0}'.format(query))
+            lines.append('# {0} hits found'.format(len(hits)))
+        for hit in hits:
+            lines.append('\t'.join(str(value) for value in (query, hit.accession,
+                hit.definition, hit.length, hit.align_length, hit.identities,
+                repr(hit.expect), int(hit.score))))
+    return '\n'.join(lines) + '\n'
+
+
+class RangeReaderTest(TempDirMixin, TestCase):
+
+    def setUp(self):
+        super(RangeReaderTest, self).setUp()
+        self.data = blast_tabular(make_blast_records())
+        self.path = self.write_file('blast.tsv', self.data)
+
+    def test_readline(self):
+        for bufsize in (1, 7, 100, 64 * 1024):
+            fi = RangeReader(self.path, 10, len(self.data) - 10, 'HEAD', 'TAIL\nEND',
+                bufsize=bufsize)
+            lines = list(iter(fi.readline, ''))
+            fi.close()
+            expected = StringIO('HEAD' + self.data[10:-10] + 'TAIL\nEND').readlines()
+            self.assertEqual(lines, expected, bufsize)
+
+    def test_read(self):
+        for size in (1, 5, 1000):
+            fi = RangeReader(self.path, 0, len(self.data), 'HEAD', 'TAIL', bufsize=100)
+            parts = [fi.readline()]
+            parts.extend(iter(lambda: fi.read(size), ''))
+            fi.close()
+            self.assertEqual(''.join(parts), 'HEAD' + self.data + 'TAIL', size)
+        fi = RangeReader(self.path, 5, 50)
+        self.assertEqual(fi.read(), self.data[5:50])
+        self.assertEqual(fi.read(), '')
+        fi.close()
+
+
+class BlastShardTest(TempDirMixin, TestCase):
+    '''
+    Parsing the shards of a BLAST output file has to give the same
+    records, in the same order, as parsing the whole file.
+    '''
+    def setUp(self):
+        super(BlastShardTest, self).setUp()
+        self.records = make_blast_records(n=300, seed=1)
+
+    def test_xml(self):
+        path = self.write_file('blast.xml', blast_xml(self.records))
+        with open(path, 'rb') as fi:
+            serial = list(parse_blast_xml(fi, expect=1e-4, max_hits=2))
+        start, end = xml_iteration_span(path)
+        for chunk_size in (1, 1000, 50000, end):
+            records = []
+            for s, e in split_ranges(path, xml_iteration_boundary, chunk_size=chunk_size,
+                    start=start, end=end):
+                records.extend(_xml_worker((path, s, e, 1e-4, 2)))
+            self.assertEqual(records, serial, chunk_size)
+
+    def test_tabular(self):
+        fields = list(TABULAR_FIELDS)
+        for comments in (False, True):
+            path = self.write_file('blast.tsv', blast_tabular(self.records, comments))
+            with open(path, 'rb') as fi:
+                serial = list(parse_blast_tabular(fi, expect=1e-4, max_hits=2, fields=fields))
+            self.assertEqual(len(serial), len([q for q, hits in self.records if hits]))
+            boundary = lambda data, pos: tabular_boundary(data, pos, fields.index('qseqid'))
+            for chunk_size in (1, 1000, 50000, os.path.getsize(path)):
+                records = []
+                for s, e in split_ranges(path, boundary, chunk_size=chunk_size):
+                    records.extend(_tabular_worker((path, s, e, 1e-4, 2, fields)))
+                self.assertEqual(records, serial, (comments, chunk_size))
+
+
+class BestTranscriptsTest(TestCase):
+    '''
+    The best transcripts selected for a whole assembly, with window
+    functions, with the grouped join or from BestTranscript, have to
+    be the ones best_for_locus picks in every locus.
+    '''
+    def setUp(self):
+        rnd = random.Random(2)
+        self.asm = Assembly.objects.create(identifier='best', k_min=21, k_max=31)
+        other = Assembly.objects.create(identifier='other', k_min=21, k_max=31)
+        for asm in (self.asm, other):
+            for locus_id in range(1, 41):
+                locus = Locus.objects.create(locus_id=locus_id, assembly=asm)
+                for transcript_id in range(1, rnd.randint(1, 8) + 1):
+                    # Few distinct values for ties in length and coverage,
+                    # 80 and 100 give lengths right at the 80% cutoff
+                    Transcript.objects.create(assembly=asm, locus=locus,
+                        transcript_id=transcript_id, confidence=0.5,
+                        length=rnd.choice((80, 100, 150, 200)),
+                        coverage=rnd.choice((0.0, 2.5, 10.0, 10.0)),
+                        sequence='')
+        self.loci = Locus.objects.filter(assembly=self.asm)
+        self.window_functions = queries.supports_window_functions
+
+    def tearDown(self):
+        queries.supports_window_functions = self.window_functions
+
+    def expected(self, cutoff):
+        return sorted(Transcript.objects.best_for_locus(locus, cutoff).pk for locus in self.loci)
+
+    def best_for_asm(self, cutoff):
+        return sorted(Transcript.objects.best_for_asm(self.asm, cutoff).values_list('pk', flat=True))
+
+    def test_window_functions(self):
+        if not self.window_functions(connection):
+            return
+        for cutoff in (0, 50, 80, 90):
+            self.assertEqual(self.best_for_asm(cutoff), self.expected(cutoff), cutoff)
+
+    def test_grouped(self):
+        queries.supports_window_functions = lambda connection: False
+        for cutoff in (0, 50, 80, 90):
+            self.assertEqual(self.best_for_asm(cutoff), self.expected(cutoff), cutoff)
+
+    def test_materialized(self):
+        BestTranscript.objects.refresh(self.asm, cutoffs=(50, 80))
+        for cutoff in (50, 80):
+            self.assertTrue(BestTranscript.objects.has_cutoff(self.asm, cutoff))
+            self.assertEqual(self.best_for_asm(cutoff), self.expected(cutoff), cutoff)
+
+
+class OrderableTest(TestCase):
+
+    def test_orderable(self):
+        for model, name in ((Locus, 'locus_id'), (Locus, '-num_transcripts'), (Locus, 'pk'),
+                (Locus, 'assembly__identifier'), (Transcript, '-coverage'), (RefSeq, 'accession')):
+            self.assertTrue(orderable(model, name), name)
+
+    def test_not_orderable(self):
+        for model, name in ((Locus, 'best_length'), (Locus, '-best_coverage'), (Locus, 'nosuch'),
+                (Locus, 'assembly__nosuch'), (Locus, 'locus_id__pk'), (Locus, '?'),
+                (Transcript, 'assembly'), (Transcript, 'locus__locus_id'),
+                (Transcript, 'blast_hits'), (Transcript, 'blasthit__score')):
+            self.assertFalse(orderable(model, name), name)
+
+
+class ImportBlastTest(TempDirMixin, TestCase):
+    '''
+    import_blast run on random BLAST output for an assembly whose loci
+    and transcripts match the queries, next to a second assembly with
+    the same transcripts.
+    '''
+    def setUp(self):
+        super(ImportBlastTest, self).setUp()
+        self.records = make_blast_records(n=60, seed=3)
+        for identifier in ('blast', 'other'):
+            asm = Assembly.objects.create(identifier=identifier, k_min=21, k_max=31)
+            for locus_id in range(1, len(self.records) + 1):
+                locus = Locus.objects.create(locus_id=locus_id, assembly=asm)
+                Transcript.objects.create(assembly=asm, locus=locus, transcript_id=1,
+                    confidence=1.0, length=1000, coverage=1.0, sequence='')
+
+    def import_blast(self, records, identifier='blast', **options):
+        path = self.write_file('blast.xml', blast_xml(records))
+        options.setdefault('expect', '1000')
+        options.setdefault('max_hits', '1000')
+        self.stdout, self.stderr = StringIO(), StringIO()
+        call_command('import_blast', path, asm=identifier,
+            stdout=self.stdout, stderr=self.stderr, **options)
+
+    def hits(self, identifier='blast'):
+        return sorted(BlastHit.objects.filter(transcript__assembly__identifier=identifier).values_list(
+            'transcript__locus__locus_id', 'refseq__accession', 'align_length', 'identities',
+            'expect', 'score'))
+
+    def expected(self, records):
+        return sorted((int(query.split('_')[1]), hit.accession, hit.align_length,
+            hit.identities, hit.expect, hit.score) for query, hits in records for hit in hits)
+
+    def test_insert(self):
+        self.import_blast(self.records)
+        self.assertEqual(self.hits(), self.expected(self.records))
+        self.assertRaises(CommandError, self.import_blast, self.records)
+        self.assertEqual(self.hits(), self.expected(self.records))
+
+    def test_upsert(self):
+        self.import_blast(self.records)
+        # Half of the records again with new scores and one new hit each
+        changed = []
+        for i, (query, hits) in enumerate(self.records[::2]):
+            hits = [hit._replace(score=hit.score + 1) for hit in hits]
+            hits.append(Hit('XR_{0:06d}'.format(i), 'New', 100, 50, 50, 0.0, 99.0))
+            changed.append((query, hits))
+        self.import_blast(changed, mode='upsert')
+        expected = dict(((row[0], row[1]), row) for row in self.expected(self.records))
+        expected.update(((row[0], row[1]), row) for row in self.expected(changed))
+        self.assertEqual(self.hits(), sorted(expected.values()))
+
+    def test_replace(self):
+        self.import_blast(self.records)
+        self.import_blast(self.records, identifier='other')
+        subset = [(query, hits[:1]) for query, hits in self.records[:30]]
+        self.import_blast(subset, mode='replace')
+        self.assertEqual(self.hits(), self.expected(subset))
+        self.assertEqual(self.hits('other'), self.expected(self.records))
+        num_hits = Transcript.objects.filter(assembly__identifier='blast').values_list(
+            'locus__locus_id', 'num_hits')
+        self.assertEqual(sorted(num_hits), [(i + 1, len(hits[:1]) if i < 30 else 0)
+            for i, (query, hits) in enumerate(self.records)])
+
+    def test_refseqs_and_unmatched(self):
+        accessions = set(hit.accession for query, hits in self.records for hit in hits)
+        existing = dict((acc, RefSeq.objects.create(accession=acc, definition='Known',
+            length=1).pk) for acc in sorted(accessions)[::2])
+        unmatched = [
+            ('Locus_999_Transcript_1/1_Confidence_1.000_Length_100', self.records[0][1]),
+            ('Locus_1_Transcript_7/7_Confidence_1.000_Length_100', self.records[0][1]),
+            ('not_a_transcript', self.records[0][1]),
+            ]
+        # Batches smaller than the file so RefSeqs are resolved across batches
+        self.import_blast(self.records + unmatched, batch_size='7')
+        self.assertEqual(self.hits(), self.expected(self.records))
+        self.assertEqual(RefSeq.objects.count(), len(accessions))
+        self.assertEqual(dict(RefSeq.objects.filter(definition='Known').values_list(
+            'accession', 'pk')), existing)
+        self.assertIn('Skipped 3 queries with no matching transcript in blast',
+            self.stderr.getvalue())
+        self.assertIn('Locus_999_Transcript_1/1', self.stderr.getvalue())
+
+    def test_missing_assembly(self):
+        # Transcripts imported before Transcript.assembly was stored
+        Transcript.objects.filter(locus__assembly__identifier='blast').update(assembly=None)
+        self.import_blast(self.records)
+        self.assertIn('Set the assembly of 60 transcripts', self.stdout.getvalue())
+        self.assertFalse(Transcript.objects.filter(assembly__isnull=True).exists())
+        self.assertEqual(self.hits(), self.expected(self.records))
+
+    def test_summary(self):
+        num_hits = sum(len(hits) for query, hits in self.records)
+        num_refseqs = len(set(hit.accession for query, hits in self.records for hit in hits))
+        message = 'Accepted {0} hits for {1} sequences ({2} new).'
+        self.import_blast(self.records)
+        self.assertIn(message.format(num_hits, num_refseqs, num_refseqs), self.stdout.getvalue())
+        self.import_blast(self.records, mode='replace')
+        self.assertIn(message.format(num_hits, num_refseqs, 0), self.stdout.getvalue())
+
+
+def make_oases(n=30, seed=0):
+    '''
+    Returns the contents of the files of a small random oases assembly
+    with n loci as a dict keyed by file name. Every transcript has at
+    least one node with a finite coverage.
+    '''
+    rnd = random.Random(seed)
+    num_nodes = n * 5
+    stats = ['ID\tlgth\tout\tin\tlong_cov\tlong_nb\tshort1_cov']
+    covered = []
+    for node_id in range(1, num_nodes + 1):
+        if node_id % 17 == 0:
+            coverage = 'Inf'
+        else:
+            coverage = '{0:.6f}'.format(rnd.uniform(0.5, 100))
+            covered.append(node_id)
+        stats.append('{0}\t{1}\t1\t1\t{2}\t0\t0'.format(node_id, rnd.randint(10, 500), coverage))
+    contigs = []
+    for node_id in range(1, num_nodes + 1, 3):
+        seq = ''.join(rnd.choice('ACGT') for i in range(rnd.randint(50, 200)))
+        contigs.append('>NODE_{0}_length_{1}_cov_{2:.6f}'.format(node_id, len(seq), rnd.uniform(0, 50)))
+        contigs.extend(seq[i:i + 60] for i in range(0, len(seq), 60))
+    transcripts = []
+    ordering = []
+    for locus_id in range(1, n + 1):
+        num_transcripts = rnd.randint(1, 5)
+        for transcript_id in range(1, num_transcripts + 1):
+            length = rnd.randint(100, 1000)
+            header = '>Locus_{0}_Transcript_{1}/{2}_Confidence_{3:.3f}_Length_{4}'.format(
+                locus_id, transcript_id, num_transcripts, rnd.random(), length)
+            seq = ''.join(rnd.choice('ACGT') for i in range(length))
+            transcripts.append(header)
+            transcripts.extend(seq[i:i + 60] for i in range(0, length, 60))
+            nodes = [rnd.choice((-1, 1)) * rnd.randint(1, num_nodes) for i in range(rnd.randint(0, 5))]
+            nodes.append(rnd.choice(covered))
+            ordering.append(header)
+            ordering.append('->'.join('{0}:{1}-(0)'.format(node, rnd.randint(10, 900))
+                for node in nodes))
+    return {
+        'stats.txt': '\n'.join(stats) + '\n',
+        'contigs.fa': '\n'.join(contigs) + '\n',
+        'transcripts.fa': '\n'.join(transcripts) + '\n',
+        'contig-ordering.txt': '\n'.join(ordering) + '\n',
+        }
+
+
+class SetupDatabaseTest(TempDirMixin, TestCase):
+    '''
+    setup_database on a small random assembly: streaming import in
+    small batches, errors on misaligned transcripts.fa and
+    contig-ordering.txt and resuming an interrupted import.
+    '''
+    def setUp(self):
+        super(SetupDatabaseTest, self).setUp()
+        self.files = make_oases()
+        for name, data in self.files.items():
+            self.write_file(name, data)
+
+    def setup_database(self, identifier, **options):
+        self.stdout = StringIO()
+        call_command('setup_database', identifier, dir=self.tmpdir, species='test',
+            k_min='21', k_max='31', batch_size='7', stdout=self.stdout, **options)
+
+    def rows(self, identifier):
+        asm = Assembly.objects.get(identifier=identifier)
+        return (
+            list(Contig.objects.filter(assembly=asm).order_by('node_id').values_list(
+                'node_id', 'length', 'coverage', 'sequence')),
+            list(Stat.objects.filter(assembly=asm).order_by('node_id').values_list(
+                'node_id', 'length', 'coverage')),
+            list(Locus.objects.filter(assembly=asm).order_by('locus_id').values_list(
+                'locus_id', 'num_transcripts', 'max_length', 'best_length', 'best_coverage')),
+            list(Transcript.objects.filter(assembly=asm).order_by(
+                'locus__locus_id', 'transcript_id').values_list(
+                'locus__locus_id', 'transcript_id', 'confidence', 'length', 'coverage',
+                'sequence')),
+            )
+
+    def test_import(self):
+        self.setup_database('asm')
+        contigs, stats, loci, transcripts = self.rows('asm')
+        self.assertEqual(len(contigs), self.files['contigs.fa'].count('>'))
+        self.assertEqual(len(stats), self.files['stats.txt'].count('\n') - 1 -
+            self.files['stats.txt'].count('Inf'))
+        self.assertEqual(len(loci), 30)
+        records = list(read_fasta(os.path.join(self.tmpdir, 'transcripts.fa')))
+        self.assertEqual([t[5] for t in transcripts], [seq for header, seq in records])
+        self.assertTrue(all(t[4] > 0 for t in transcripts))
+        self.assertEqual(Transcript.objects.filter(assembly__identifier='asm').count(),
+            sum(locus[1] for locus in loci))
+        self.assertRaises(CommandError, self.setup_database, 'asm')
+
+    def assertMisaligned(self, ordering, message):
+        self.write_file('contig-ordering.txt', ordering)
+        with self.assertRaises(CommandError) as cm:
+            self.setup_database('asm')
+        self.assertIn(message, str(cm.exception))
+
+    def test_missing_ordering(self):
+        lines = self.files['contig-ordering.txt'].splitlines(True)
+        self.assertMisaligned(''.join(lines[:-2]), 'contig-ordering.txt has no entry')
+
+    def test_extra_ordering(self):
+        extra = '>Locus_99_Transcript_1/1_Confidence_1.000_Length_100\n1:10-(0)\n'
+        self.assertMisaligned(self.files['contig-ordering.txt'] + extra,
+            'transcripts.fa has no entry for Locus 99 Transcript 1')
+
+    def test_swapped_ordering(self):
+        lines = self.files['contig-ordering.txt'].splitlines(True)
+        lines[20:22], lines[22:24] = lines[22:24], lines[20:22]
+        self.assertMisaligned(''.join(lines), 'does not match')
+
+    def test_resume(self):
+        self.setup_database('clean')
+        # Interrupted in the transcripts phase after a few batches
+        lines = self.files['contig-ordering.txt'].splitlines(True)
+        self.write_file('contig-ordering.txt', ''.join(lines[:40]))
+        self.assertRaises(CommandError, self.setup_database, 'asm')
+        checkpoint = ImportPhase.objects.get(assembly__identifier='asm', phase='transcripts')
+        self.assertFalse(checkpoint.completed)
+        self.assertTrue(0 < checkpoint.rows < 20)
+        self.write_file('contig-ordering.txt', self.files['contig-ordering.txt'])
+        self.assertRaises(CommandError, self.setup_database, 'asm')
+        self.setup_database('asm', resume=True)
+        self.assertIn('Resuming transcripts after', self.stdout.getvalue())
+        self.assertEqual(self.rows('asm'), self.rows('clean'))
+
+
+class KeysetPaginatorTest(TestCase):
+    '''
+    Walking all pages forward with after and back with before has to
+    give every row exactly once, in the order of the full query.
+    '''
+    def setUp(self):
+        rnd = random.Random(4)
+        self.asm = Assembly.objects.create(identifier='keyset', k_min=21, k_max=31)
+        for locus_id in rnd.sample(range(1, 1000), 50):
+            # Few distinct values for ties
+            Locus.objects.create(locus_id=locus_id, assembly=self.asm,
+                num_transcripts=rnd.randint(1, 4), max_length=rnd.choice((100, 200)))
+        self.qs = Locus.objects.filter(assembly=self.asm)
+
+    def walk(self, ordering, per_page=7):
+        paginator = KeysetPaginator(self.qs, ordering, per_page)
+        pages = [paginator.page()]
+        while pages[-1].has_next:
+            pages.append(paginator.page(after=pages[-1].next_cursor))
+        forward = [obj.pk for page in pages for obj in page.object_list]
+        self.assertFalse(pages[0].has_previous)
+        pages = [pages[-1]]
+        while pages[-1].has_previous:
+            pages.append(paginator.page(before=pages[-1].previous_cursor))
+        backward = [obj.pk for page in reversed(pages) for obj in page.object_list]
+        expected = list(self.qs.order_by(*(list(ordering) + ['pk'])).values_list('pk', flat=True))
+        self.assertEqual(forward, expected, ordering)
+        self.assertEqual(backward, expected, ordering)
+
+    def test_walk(self):
+        for ordering in (['locus_id'], ['-locus_id'], ['-num_transcripts'],
+                ['max_length', '-num_transcripts'], ['-max_length', 'num_transcripts', '-locus_id']):
+            self.walk(ordering)
+        self.walk(['-num_transcripts'], per_page=50)
+        self.walk(['num_transcripts'], per_page=1)
+
+    def test_invalid_cursor(self):
+        view = FilteredListView.as_view(model=Locus, template_name='tasm/loci_list.html',
+            keyset=True)
+        url = '/tasm/asm/{0}/loci/'.format(self.asm.pk)
+        for params in ({'after': 'garbage'}, {'before': encode_cursor([1])},
+                {'after': encode_cursor({'a': 1})}):
+            request = RequestFactory().get(url, params)
+            self.assertRaises(Http404, view, request, asm_pk=str(self.asm.pk))
+        response = view(RequestFactory().get(url), asm_pk=str(self.asm.pk))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context_data['object_list']), 20)
+
+
+LOCMEM_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    CACHE_ALIAS: {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'tasm-tests',
+        },
+    }
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ListCacheTest(TempDirMixin, TestCase):
+
+    def setUp(self):
+        super(ListCacheTest, self).setUp()
+        get_list_cache().clear()
+        self.asm = Assembly.objects.create(identifier='cache', k_min=21, k_max=31)
+        self.params = {'filters': [('length__gte', u'500')], 'ordering': ['-coverage'],
+            'after': None, 'before': None}
+
+    def key(self, path='/tasm/asm/1/transcripts/', **params):
+        return list_cache_key(path, self.asm.pk, dict(self.params, **params))
+
+    def test_keys(self):
+        key = self.key()
+        self.assertEqual(self.key(), key)
+        others = [
+            self.key(path='/tasm/asm/1/best/'),
+            self.key(filters=[('length__gte', u'501')]),
+            self.key(filters=[]),
+            self.key(ordering=['coverage']),
+            self.key(after=encode_cursor([1.0, 2])),
+            self.key(before=encode_cursor([1.0, 2])),
+            self.key(after=encode_cursor([1.0, 3])),
+            ]
+        self.assertEqual(len(set(others + [key])), len(others) + 1)
+
+    def test_invalidate(self):
+        key = self.key()
+        other = Assembly.objects.create(identifier='other', k_min=21, k_max=31)
+        asm_generation = generations(self.asm.pk)[1]
+        invalidate(other.pk)
+        self.assertEqual(generations(self.asm.pk)[1], asm_generation)
+        self.assertNotEqual(self.key(), key)
+        key = self.key()
+        invalidate(self.asm.pk)
+        self.assertNotEqual(generations(self.asm.pk)[1], asm_generation)
+        self.assertNotEqual(self.key(), key)
+
+    def assertInvalidated(self, func, *args, **kwargs):
+        cache = get_list_cache()
+        key = self.key()
+        cache.set(key, 'page')
+        before = generations(self.asm.pk)
+        self.assertRaises(CommandError, func, *args, **kwargs)
+        after = generations(self.asm.pk)
+        self.assertTrue(after[0] > before[0] and after[1] > before[1], (before, after))
+        self.assertIsNone(cache.get(self.key()))
+
+    def test_failed_import_blast(self):
+        path = self.write_file('blast.tsv', 'Locus_1_Transcript_1/1\tNM_000001\n')
+        self.assertInvalidated(call_command, 'import_blast', path, asm='cache',
+            stdout=StringIO(), stderr=StringIO())
+
+    def test_failed_setup_database(self):
+        files = make_oases()
+        for name, data in files.items():
+            self.write_file(name, data)
+        lines = files['contig-ordering.txt'].splitlines(True)
+        self.write_file('contig-ordering.txt', ''.join(lines[:40]))
+        before = generations()[0]
+        self.assertRaises(CommandError, call_command, 'setup_database', 'failed',
+            dir=self.tmpdir, species='test', k_min='21', k_max='31', batch_size='7',
+            stdout=StringIO())
+        # Part of the assembly was written, cached lists must go
+        self.assertTrue(Transcript.objects.filter(assembly__identifier='failed').exists())
+        self.assertTrue(generations()[0] > before)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class HomeViewTest(TestCase):
+
+    def setUp(self):
+        get_list_cache().clear()
+        refseqs = [RefSeq.objects.create(accession='NM_{0:06d}'.format(i), definition='',
+            length=100) for i in range(3)]
+        for identifier in ('a', 'b'):
+            asm = Assembly.objects.create(identifier=identifier, k_min=21, k_max=31)
+            locus = Locus.objects.create(locus_id=1, assembly=asm)
+            transcript = Transcript.objects.create(assembly=asm, locus=locus, transcript_id=1,
+                confidence=1.0, length=1000, coverage=1.0, sequence='')
+            for refseq in refseqs[:2]:
+                BlastHit.objects.create(transcript=transcript, refseq=refseq, align_length=100,
+                    identities=100, expect=0.0, score=200.0)
+            Transcript.objects.refresh_num_hits(asm)
+            Locus.objects.refresh_summaries(asm)
+            AssemblyStats.objects.refresh(asm)
+
+    def stat(self):
+        response = HomeView.as_view()(RequestFactory().get('/tasm/'))
+        return response.context_data['stat']
+
+    def test_refseqs(self):
+        self.assertEqual([s.num_refseqs for s in AssemblyStats.objects.all()], [2, 2])
+        self.assertEqual(self.stat(), {'transcripts': 2, 'loci': 2, 'refseqs': 3})
+        RefSeq.objects.create(accession='NM_000004', definition='', length=100)
+        # Only the AssemblyStats totals, the RefSeq count is cached
+        with self.assertNumQueries(1):
+            self.assertEqual(self.stat()['refseqs'], 3)
+        invalidate()
+        self.assertEqual(self.stat()['refseqs'], 4)
+
+
+class SequencePreviewTest(TestCase):
+
+    def test_preview_truncated(self):
+        asm = Assembly.objects.create(identifier='preview', k_min=21, k_max=31)
+        locus = Locus.objects.create(locus_id=1, assembly=asm)
+        for transcript_id, length in enumerate((59, 60, 61, 500), 1):
+            Transcript.objects.create(assembly=asm, locus=locus, transcript_id=transcript_id,
+                confidence=1.0, length=length, coverage=1.0, sequence='A' * length)
+        transcripts = Transcript.objects.with_preview().filter(assembly=asm).order_by('length')
+        self.assertEqual([len(t.sequence_preview) for t in transcripts], [59, 60, 60, 60])
+        self.assertEqual([t.preview_truncated for t in transcripts], [False, False, True, True])
@@ -24,35 +24,49 @@ urlpatterns = patterns('',
     url(r'^refseqs/$', views.FilteredListView.as_view(
         model=RefSeq,
         template_name='tasm/refseq_list.html',
-        form_class=RefSeqFilterForm
+        form_class=RefSeqFilterForm,
+        keyset=True,
+        cache_results=True
         ), name='tasm_refseq_list_view'),
         
     url(r'^asm/(?P<asm_pk>\d+)/loci/$', views.FilteredListView.as_view(
         model=Locus,
-        template_name='tasm/loci_list.html'
+        template_name='tasm/loci_list.html',
+        keyset=True,
+        estimate_count=True,
+        cache_results=True
         ), name='tasm_loci_for_asm_view'),
     url(r'^asm/(?P<asm_pk>\d+)/transcripts/$', views.FilteredListView.as_view(
         model=Transcript,
         template_name='tasm/trasncript_list.html',
         form_class=TranscriptFilterForm,
-        view_name='tasm_transcripts_for_asm_view'
+        view_name='tasm_transcripts_for_asm_view',
+        keyset=True,
+        estimate_count=True,
+        cache_results=True
         ), name='tasm_transcripts_for_asm_view'),
     
     url(r'^asm/(?P<asm_pk>\d+)/best/$', views.BestTranscriptsView.as_view(
         template_name='tasm/trasncript_list.html',
         form_class=TranscriptFilterForm,
-        view_name='tasm_best_transcripts_for_asm_view'
+        view_name='tasm_best_transcripts_for_asm_view',
+        keyset=True,
+        cache_results=True
         ), name='tasm_best_transcripts_for_asm_view'),
     url(r'^asm/(?P<asm_pk>\d+)/orphans/$', views.BestOrphansView.as_view(
         template_name='tasm/trasncript_list.html',
         form_class=TranscriptFilterForm,
-        view_name='tasm_orphan_transcripts_for_asm_view'
+        view_name='tasm_orphan_transcripts_for_asm_view',
+        keyset=True,
+        cache_results=True
         ), name='tasm_orphan_transcripts_for_asm_view'),
 
     url(r'^asm/(?P<asm_pk>\d+)/hits/$', views.FilteredListView.as_view(
         model=RefSeq,
         template_name='tasm/refseq_list.html',
-        form_class=RefSeqFilterForm
+        form_class=RefSeqFilterForm,
+        keyset=True,
+        cache_results=True
         ), name='tasm_refseqs_for_asm_view'),
     url(r'^asm/(?P<asm_pk>\d+)/plots/$', views.TranscriptPlotView.as_view(
         template_name='tasm/plots.html',
@@ -73,6 +87,8 @@ urlpatterns = patterns('',
         model=Transcript,
         template_name='tasm/transcript_list.html',
         context_object_name='locus'), name='tasm_transcript_view'),
+    url(r'^transcripts/(?P<pk>\d+)/sequence/$', views.TranscriptSequenceView.as_view(),
+        name='tasm_transcript_sequence_view'),
         
     url(r'^asm/(?P<asm_pk>\d+)/plot/$', plotting.TranscriptPlotView.as_view(),
         name='tasm_transcripts_plot_for_asm_view'),
@@ -1,4 +1,8 @@
+import csv
 import operator
+from itertools import chain, islice
+
+import numpy as np
 
 def parse_header(header):
     '''
@@ -35,11 +39,136 @@ def get_contig_ids(transcript):
     format and returns a list of contig ids to be used in database
     query to compute transcript coverage.
     '''
-    bits = transcript.tostring().split('->')
+    bits = transcript.split('->')
     ctg_ids = [abs(int(ctg.split(':')[0])) for ctg in bits]
     return ctg_ids
 
 
+def batches(iterable, size):
+    '''
+    Splits iterable into lists of at most size items. Only one batch
+    is held in memory at a time.
+    '''
+    it = iter(iterable)
+    while True:
+        batch = list(islice(it, size))
+        if not batch:
+            break
+        yield batch
+
+
+def build_coverage_index(handle):
+    '''
+    Takes an open stats.txt file and returns a numpy array of node
+    coverage values (long_cov) indexed by node id. Nodes reported with
+    'Inf' coverage and ids missing from the file are set to NaN, which
+    mirrors the Stat table where such nodes are never stored.
+    '''
+    ids = []
+    covs = []
+    for rec in csv.DictReader(handle, delimiter='\t'):
+        if rec['long_cov'] != 'Inf':
+            ids.append(int(rec['ID']))
+            covs.append(float(rec['long_cov']))
+    size = max(ids) + 1 if ids else 0
+    index = np.empty(size, dtype=np.float64)
+    index.fill(np.nan)
+    index[ids] = covs
+    return index
+
+
+def transcript_coverage(index, contig_ids):
+    '''
+    Computes the coverage of every transcript as a geometric mean of
+    the coverage of its nodes. contig_ids is a sequence with a list of
+    node ids (as returned by get_contig_ids) per transcript; index is
+    the array returned by build_coverage_index.
+
+    This is equivalent to calling scipy.stats.gmean on the Stat
+    coverage values of every transcript: repeated node ids are
+    counted once (as they would be by a node_id__in query) and nodes
+    without coverage are ignored. Transcripts with no covered nodes
+    get NaN. Returns a numpy array with one value per transcript.
+    '''
+    counts = np.array([len(ids) for ids in contig_ids], dtype=np.int64)
+    if not counts.sum():
+        coverage = np.empty(len(counts), dtype=np.float64)
+        coverage.fill(np.nan)
+        return coverage
+    groups = np.repeat(np.arange(len(counts)), counts)
+    nodes = np.concatenate([np.asarray(ids, dtype=np.int64) for ids in contig_ids if len(ids)])
+    # Drop repeated nodes within a transcript by encoding every
+    # (transcript, node) pair as a single integer key
+    stride = max(int(nodes.max()) + 1, len(index))
+    keys = np.unique(groups * stride + nodes)
+    groups = keys // stride
+    nodes = keys % stride
+    values = np.empty(len(nodes), dtype=np.float64)
+    values.fill(np.nan)
+    known = nodes < len(index)
+    values[known] = index[nodes[known]]
+    covered = ~np.isnan(values)
+    groups = groups[covered]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        logs = np.log(values[covered])
+        sums = np.bincount(groups, weights=logs, minlength=len(counts))
+        n = np.bincount(groups, minlength=len(counts))
+        return np.exp(sums / n)
+
+
+def n50(lengths):
+    '''
+    Returns the N50 of a sequence of transcript (or contig) lengths:
+    the length L such that sequences of length L or longer make up at
+    least half of the total length. 0 for no sequences.
+    '''
+    lengths = np.sort(np.asarray(lengths, dtype=np.int64))[::-1]
+    if not len(lengths):
+        return 0
+    cumsum = np.cumsum(lengths)
+    return int(lengths[np.searchsorted(cumsum, cumsum[-1] / 2.0)])
+
+
+def parse_query_id(query):
+    '''
+    Takes a transcript header as used for BLAST query ids, e.g.
+        Locus_1_Transcript_5/59_Confidence_0.009_Length_195
+    and returns a (locus_id, transcript_id) tuple, or None if the id
+    is not in that form.
+    '''
+    bits = query.split('_')
+    try:
+        return int(bits[1]), int(bits[3].split('/')[0])
+    except (IndexError, ValueError):
+        return None
+
+
+class TranscriptIndex(object):
+    '''
+    Maps (locus_id, transcript_id) of the transcripts of an assembly to
+    Transcript pks without hitting the database. rows is an iterable
+    of (locus_id, transcript_id, pk) tuples, e.g. a values_list query.
+    Both ids are packed into a single int64 key and kept in a sorted
+    numpy array, which takes a fraction of the memory of a dict.
+    '''
+    def __init__(self, rows):
+        data = np.fromiter(chain.from_iterable(rows), dtype=np.int64).reshape(-1, 3)
+        keys = (data[:, 0] << 32) | data[:, 1]
+        order = np.argsort(keys, kind='mergesort')
+        self.keys = keys[order]
+        self.pks = data[order, 2]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get(self, locus_id, transcript_id, default=None):
+        key = (locus_id << 32) | transcript_id
+        i = np.searchsorted(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return int(self.pks[i])
+        return default
+
+
 def get_next_hit(handle):
     '''
     Takes an open blastresults.txt file and returns hits per
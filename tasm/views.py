@@ -1,5 +1,7 @@
 from django.db import models
-from django.db.models import Count
+from django.db.models import Sum
+from django.db.models.fields import FieldDoesNotExist
+from django.http import Http404, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.core.urlresolvers import reverse, reverse_lazy
 from django.views.generic import View, FormView, TemplateView
@@ -7,33 +9,74 @@ from django.views.generic.list import ListView
 from django.views.generic.edit import BaseFormView
 from django.utils.encoding import smart_str
 
-from tasm.models import Assembly, RefSeq, Contig, Locus, Transcript
+from tasm.models import (Assembly, AssemblyStats, RefSeq, Contig, Locus, Transcript,
+    BestTranscript, BEST_CUTOFFS)
+from tasm.keyset import KeysetPaginator, InvalidCursor, estimated_count, orderable
+from tasm.cache import get_list_cache, list_cache_key
 
 ALLOWED_LOOKUPS = ('iexact', 'icontains', 'in', 'gt', 'gte', 'lt',
     'lte', 'istratswith', 'iendswith', 'range', 'isnull', 'iregex')
 
+def spans_multiple(model, lookup):
+    '''
+    True if lookup (e.g. locus__transcript__length__gte) follows a
+    reverse foreign key or a many-to-many relation of model.
+    '''
+    opts = model._meta
+    for name in lookup.split('__'):
+        try:
+            field, field_model, direct, m2m = opts.get_field_by_name(name)
+        except FieldDoesNotExist:
+            return False
+        if m2m:
+            return True
+        if not direct:
+            # Reverse relation, single valued only for one-to-one
+            if not field.field.unique:
+                return True
+            opts = field.model._meta
+        elif field.rel:
+            opts = field.rel.to._meta
+        else:
+            return False
+    return False
+
 class HomeView(ListView):
     model = Assembly
     template_name = 'tasm/home.html'
     
     def get_queryset(self):
+        # Per assembly numbers come from AssemblyStats, refreshed on import
         qs = super(HomeView, self).get_queryset()
-        return qs.annotate(
-            num_transcripts=Count('locus__transcript'),
-            num_loci=Count('locus', distinct=True),
-            num_hits=Count('locus__transcript__blasthit__refseq')
-        )
+        return qs.select_related('stats')
     
     def get_context_data(self, **kwargs):
         context = super(HomeView, self).get_context_data(**kwargs)
+        totals = AssemblyStats.objects.aggregate(
+            transcripts=Sum('num_transcripts'),
+            loci=Sum('num_loci'))
         stat_dict = {
-            'transcripts': Transcript.objects.all().count(),
-            'refseqs': RefSeq.objects.all().count(),
-            'loci': Locus.objects.all().count(),
+            'transcripts': totals['transcripts'] or 0,
+            'refseqs': self.get_refseq_count(),
+            'loci': totals['loci'] or 0,
             }
         context['stat'] = stat_dict
         return context
 
+    def get_refseq_count(self):
+        '''
+        RefSeqs are shared by the assemblies, so the total can't be
+        summed up from AssemblyStats. It is cached until the next
+        import instead (see tasm.cache).
+        '''
+        cache = get_list_cache()
+        key = list_cache_key(self.request.path, None, {'count': 'refseqs'})
+        count = cache.get(key)
+        if count is None:
+            count = RefSeq.objects.count()
+            cache.set(key, count)
+        return count
+
 class TranscriptPlotView(TemplateView):
     view_name = None
     
@@ -44,9 +87,45 @@ class TranscriptPlotView(TemplateView):
         return context
     
     
+class TranscriptSequenceView(View):
+    '''
+    Full sequence of a single transcript as FASTA, streamed in lines of
+    line_length bases. Lists only show the first bases of a sequence.
+    '''
+    line_length = 60
+
+    def get_lines(self, header, sequence):
+        yield '>{0}\n'.format(header)
+        for i in range(0, len(sequence), self.line_length):
+            yield sequence[i:i + self.line_length] + '\n'
+
+    def get(self, request, *args, **kwargs):
+        transcript = get_object_or_404(
+            Transcript.objects.select_related('locus', 'assembly'), pk=int(self.kwargs['pk']))
+        header = '{asm}_Locus_{locus}_Transcript_{trans}_Length_{length}'.format(
+            asm=transcript.assembly or '',
+            locus=transcript.locus.locus_id if transcript.locus else '',
+            trans=transcript.transcript_id,
+            length=transcript.length)
+        response = StreamingHttpResponse(
+            self.get_lines(header, transcript.sequence), content_type='text/plain')
+        if 'download' in request.GET:
+            response['Content-Disposition'] = 'attachment; filename="transcript_{0}.fa"'.format(
+                transcript.pk)
+        return response
+
+
 class FilteredListView(ListView):
     form_class = None
     view_name = None
+    # Page through the list with after/before cursors instead of page
+    # numbers (see tasm.keyset) and show the planner's row estimate
+    # instead of an exact count.
+    keyset = False
+    keyset_per_page = 20
+    estimate_count = False
+    # Cache the pages of keyset paginated lists (see tasm.cache)
+    cache_results = False
     
     def __init__(self, *args, **kwargs):
         super(FilteredListView, self).__init__(**kwargs)
@@ -57,7 +136,11 @@ class FilteredListView(ListView):
         params = request.GET.copy()
         params.pop('page', None)
         params.pop('_filter', None)
-        self.ordering = params.pop('o', [])
+        params.pop('cutoff', None)
+        params.pop('after', None)
+        params.pop('before', None)
+        # Unknown and nullable fields can't be keyset paginated
+        self.ordering = [name for name in params.pop('o', []) if orderable(self.model, name)]
         opts = self.model._meta
         filters = {}
         # GET parameters from the search form
@@ -86,19 +169,81 @@ class FilteredListView(ListView):
         # Parameters from URL
         if 'asm_pk' in self.kwargs:
             if self.model == Transcript:
-                asm_key = 'locus__assembly__pk'
+                asm_key = 'assembly__pk'
             elif self.model == Locus:
                 asm_key = 'assembly__pk'
             else:
-                asm_key = 'transcript__locus__assembly_id'
+                asm_key = 'transcript__assembly__pk'
             filters.update({asm_key: int(self.kwargs['asm_pk']),})
         return filters
 
     def get_queryset(self):
         qs = super(FilteredListView, self).get_queryset()
-        return qs.filter(**self.filters).distinct().order_by(*self.ordering)
-    
+        if self.model == Transcript:
+            qs = Transcript.objects.with_preview(qs)
+        qs = qs.filter(**self.filters).order_by(*self.ordering)
+        if self.needs_distinct():
+            qs = qs.distinct()
+        return qs
+
+    def needs_distinct(self):
+        '''
+        True if a filter or the ordering goes through a multi-valued
+        relation and may return a row more than once.
+        '''
+        lookups = list(self.filters) + [name.lstrip('-') for name in self.ordering]
+        return any(spans_multiple(self.model, lookup) for lookup in lookups)
+
+    def get_ordering(self):
+        return list(self.ordering) or list(self.model._meta.ordering)
+
+    def _keyset_query(self):
+        params = self.request.GET.copy()
+        for key in ('page', 'after', 'before'):
+            params.pop(key, None)
+        query = params.urlencode()
+        return query + '&' if query else ''
+
+    def get_cache_params(self):
+        return {
+            'filters': sorted(self.filters.items()),
+            'ordering': self.get_ordering(),
+            'after': self.request.GET.get('after'),
+            'before': self.request.GET.get('before'),
+            }
+
+    def get_keyset_page(self):
+        paginator = KeysetPaginator(self.object_list, self.get_ordering(), self.keyset_per_page)
+        try:
+            page = paginator.page(
+                after=self.request.GET.get('after'),
+                before=self.request.GET.get('before'))
+        except InvalidCursor as e:
+            raise Http404(e)
+        count = estimated_count(self.object_list) if self.estimate_count else None
+        return page, count
+
+    def get_keyset_context(self):
+        if self.cache_results:
+            cache = get_list_cache()
+            key = list_cache_key(self.request.path, self.kwargs.get('asm_pk'), self.get_cache_params())
+            result = cache.get(key)
+            if result is None:
+                result = self.get_keyset_page()
+                cache.set(key, result)
+        else:
+            result = self.get_keyset_page()
+        page, count = result
+        return {
+            'object_list': page.object_list,
+            'keyset_page': page,
+            'keyset_query': self._keyset_query(),
+            'estimated_count': count,
+            }
+
     def get_context_data(self,  **kwargs):
+        if self.keyset:
+            kwargs.update(self.get_keyset_context())
         context = super(FilteredListView, self).get_context_data(**kwargs)
         context['active_view'] = self.view_name
         if self.form_class:
@@ -119,14 +264,46 @@ class FilteredListView(ListView):
         return super(FilteredListView, self).get(request, *args, **kwargs)
 
 class BestTranscriptsView(FilteredListView):
+    '''
+    Best transcript of every locus of the assembly. The length cutoff
+    is taken from the cutoff GET parameter; precomputed cutoffs are
+    read from BestTranscript, others are computed on the fly.
+    '''
     model = Transcript
 
+    def get_cutoff(self):
+        try:
+            cutoff = int(self.request.GET.get('cutoff', BEST_CUTOFFS[0]))
+        except ValueError:
+            return BEST_CUTOFFS[0]
+        return min(max(cutoff, 0), 100)
+
     def get_queryset(self):
-        asm = Assembly.objects.get(pk=int(self.kwargs['asm_pk']))
-        return self.model._default_manager.best_for_asm(asm).filter(**self.filters).distinct().order_by('-coverage')
+        self.asm = Assembly.objects.get(pk=int(self.kwargs['asm_pk']))
+        self.cutoff = self.get_cutoff()
+        qs = self.model._default_manager.best_for_asm(self.asm, self.cutoff)
+        qs = self.model._default_manager.with_preview(qs).filter(
+            **self.filters).order_by(*self.get_ordering())
+        if self.needs_distinct():
+            qs = qs.distinct()
+        return qs
+
+    def get_ordering(self):
+        return list(self.ordering) or ['-coverage']
+
+    def get_cache_params(self):
+        params = super(BestTranscriptsView, self).get_cache_params()
+        params['cutoff'] = self.cutoff
+        return params
+
+    def get_context_data(self, **kwargs):
+        context = super(BestTranscriptsView, self).get_context_data(**kwargs)
+        context['cutoff'] = self.cutoff
+        context['best_cutoffs'] = BestTranscript.objects.cutoffs_for(self.asm)
+        return context
 
 class BestOrphansView(BestTranscriptsView):
 
     def get_queryset(self):
         qs = super(BestOrphansView, self).get_queryset()
-        return qs.filter(blast_hits__isnull=True)
\ No newline at end of file
+        return qs.filter(num_hits=0)
\ No newline at end of file
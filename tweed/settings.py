@@ -101,6 +101,29 @@ INSTALLED_APPS = (
     'gunicorn'
 )
 
+# Length cutoffs (in % of the longest transcript in a locus) for which
+# the best transcript of every locus is precomputed on import
+TASM_BEST_CUTOFFS = (80,)
+
+# Pages of the transcript, locus and refseq lists are cached in
+# TASM_CACHE and invalidated by setup_database and import_blast. The
+# imports run in other processes than the web server, so the cache has
+# to be shared (file based or memcached, not locmem).
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'tasm': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': '/var/tmp/tweed_cache',
+        'TIMEOUT': 600,
+        'OPTIONS': {
+            'MAX_ENTRIES': 5000,
+        },
+    },
+}
+TASM_CACHE = 'tasm'
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,